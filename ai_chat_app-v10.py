@@ -4,20 +4,1160 @@ import yaml
 import os
 import requests
 from PyQt6.QtWidgets import (
-    QApplication, QMainWindow, QTextBrowser, QTextEdit,
+    QApplication, QMainWindow, QTextEdit,
     QPushButton, QVBoxLayout, QHBoxLayout, QWidget,
     QMenuBar, QMenu, QFileDialog, QMessageBox,
     QDialog, QFormLayout, QLabel, QSlider, QComboBox,
     QDialogButtonBox, QGridLayout,
-    QToolButton, QLineEdit
+    QToolButton, QLineEdit, QListView, QAbstractItemView,
+    QStyledItemDelegate, QStyle, QDockWidget, QProgressBar, QListWidget, QListWidgetItem, QCheckBox
+)
+from PyQt6.QtCore import (
+    Qt, QDateTime, QThread, QTimer, pyqtSignal,
+    QAbstractListModel, QModelIndex, QSize, QRectF, QPointF, QUrl, QEvent
+)
+from PyQt6.QtGui import (
+    QAction, QFont, QKeySequence, QTextDocument, QColor, QPainter, QDesktopServices
 )
-from PyQt6.QtCore import Qt, QDateTime
-from PyQt6.QtGui import QAction, QTextCursor, QFont
 from urllib.parse import urlparse
-from openai import OpenAI
+from openai import OpenAI, DefaultHttpxClient, APIStatusError, APIConnectionError
+try:
+    import httpx
+except ImportError:  # openai releases built on the httpx2 fork
+    import httpx2 as httpx
 import html
 import datetime  # Import datetime
 import re  # Added for regex transformation
+import time
+import random
+import email.utils
+import logging
+import queue
+import hashlib
+import threading
+import sqlite3
+import zlib
+import multiprocessing
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict, deque
+try:
+    import numpy as np
+except ImportError:  # Optional: only the semantic response cache needs it
+    np = None
+
+
+# --- Session log files ---
+# A live session is written as an append-only journal (Chat_*.jsonl): one JSON record per line,
+# a "session" header followed by one "message" record per chat entry, and a "meta" record with the
+# timings and token usage of each AI reply. When the session is closed the journal is compacted into the
+# classic Chat_*.json document, which is what older versions read: chat_log entries stay
+# [sender, message, timestamp], and the reply metadata goes to a separate "message_meta" map keyed by
+# the entry's index in chat_log.
+SESSION_JOURNAL_EXT = ".jsonl"
+
+
+def load_session_file(path):
+    """Read a session log in either the journal (.jsonl) or the compacted (.json) format."""
+    if path.endswith(SESSION_JOURNAL_EXT):
+        return read_session_journal(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError("not a chat session document")
+    data.setdefault('chat_log', [])
+    data.setdefault('message_meta', {})
+    return data
+
+
+def is_valid_chat_log(chat_log):
+    # Every reader unpacks entries as sender, message, timestamp
+    return isinstance(chat_log, list) and all(
+        isinstance(entry, list) and len(entry) == 3 and all(isinstance(field, str) for field in entry)
+        for entry in chat_log)
+
+
+def read_session_journal(path):
+    data = {"session_name": os.path.splitext(os.path.basename(path))[0], "chat_log": [], "message_meta": {}}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break  # A torn last line from a crash; everything before it is intact
+            if record.get("type") == "session":
+                data["session_name"] = record.get("session_name", data["session_name"])
+            elif record.get("type") == "message":
+                data["chat_log"].append(record["entry"])
+            elif record.get("type") == "meta":
+                data["message_meta"][str(record["index"])] = record["meta"]  # String keys, as in the .json
+    return data
+
+
+def compact_session_journal(journal_path):
+    """Rewrite a journal as a Chat_*.json document next to it and remove the journal."""
+    data = read_session_journal(journal_path)
+    data["attached_files"] = {}
+    data["created_at"] = datetime.datetime.now().timestamp()
+    json_path = journal_path[:-len(SESSION_JOURNAL_EXT)] + ".json"
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, json_path)  # Atomic, so a crash never leaves a half-written .json
+    os.remove(journal_path)
+    return json_path
+
+
+class SessionLogWriter(QThread):
+    # Write-behind logger: the GUI only enqueues records, this thread does all the disk I/O.
+    # Durability policies:
+    #   flush          - hand every batch to the OS right away (default)
+    #   fsync_every_n  - flush every batch and fsync after every `fsync_every` records
+    #   fsync_on_close - let the file buffer fill, flush and fsync once when the session closes
+    write_failed = pyqtSignal(str)
+
+    DURABILITY_POLICIES = ("flush", "fsync_every_n", "fsync_on_close")
+
+    def __init__(self, path, durability="flush", fsync_every=10, queue_size=1000, batch_size=64, parent=None):
+        super().__init__(parent)
+        if durability not in self.DURABILITY_POLICIES:
+            durability = "flush"
+        self.path = path
+        self.durability = durability
+        self.fsync_every = max(1, fsync_every)
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        # Records that arrive while the queue is full go here instead of blocking the GUI. Once anything
+        # has spilled, later records spill too until the writer has caught up, so order is kept.
+        self.spill = []
+        self.spill_lock = threading.Lock()
+
+    def submit(self, record):
+        with self.spill_lock:
+            if not self.spill:
+                try:
+                    self.queue.put_nowait(record)
+                    return
+                except queue.Full:
+                    pass  # The disk has stalled; never make the caller wait for it
+            self.spill.append(record)
+
+    def close(self):
+        self.submit(None)  # Sentinel: write what is queued, then stop
+        self.wait()
+
+    def next_batch(self):
+        # Queued records come first; spilled ones are newer, so they are taken once the queue is empty
+        with self.spill_lock:
+            if self.spill and self.queue.empty():
+                batch, self.spill = self.spill, []
+                return batch
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        try:
+            log_file = open(self.path, 'a', encoding='utf-8')
+        except Exception as e:
+            self.write_failed.emit(f"Could not create session log file: {e}")
+            log_file = None
+
+        unsynced = 0
+        closing = False
+        while not closing:
+            batch = self.next_batch()
+            if None in batch:
+                closing = True
+                batch = batch[:batch.index(None)]
+            if log_file is None or not batch:
+                continue  # Keep draining so the spill does not grow behind a dead log
+            try:
+                log_file.write("".join(json.dumps(record) + "\n" for record in batch))
+                if self.durability != "fsync_on_close":
+                    log_file.flush()
+                unsynced += len(batch)
+                if self.durability == "fsync_every_n" and unsynced >= self.fsync_every:
+                    os.fsync(log_file.fileno())
+                    unsynced = 0
+            except Exception as e:
+                self.write_failed.emit(f"Could not write to session log file: {e}")
+
+        if log_file is not None:
+            try:
+                log_file.flush()
+                if self.durability != "flush":
+                    os.fsync(log_file.fileno())
+                log_file.close()
+            except Exception as e:
+                self.write_failed.emit(f"Could not close session log file properly: {e}")
+
+
+# --- WhatsApp-style formatting ---
+# Linear-time formatter. The text is tokenized once into plain text, runs of '*', '_', '~' and line
+# breaks. Per line, '****x****', '***x***' and '**x**' are paired on the star runs (leftmost,
+# non-greedy, in that order), which renders them as <b>***x***</b>, <b>**x**</b> and <b>*x*</b>.
+# The remaining '*', '_' and '~' then toggle <b>, <i> and <s> across the whole message, and a tag
+# pair with nothing between it is dropped. Bold pairs are resolved before italic and italic before
+# strike, so an empty pair of an earlier style does not separate a later pair.
+WHATSAPP_TOKEN_PATTERN = re.compile(r"\*+|\n|[_~]|[^*\n_~]+")
+SURROGATE_PATTERN = re.compile("[\ud800-\udfff]")
+WHATSAPP_TOGGLE_TAGS = (("<b>", "</b>"), ("<i>", "</i>"), ("<s>", "</s>"))
+WHATSAPP_TOGGLE_LEVELS = {"_": 1, "~": 2}
+
+
+def _pair_star_runs(segments, width):
+    # One leftmost, non-greedy pass of `\*{width}(.*?)\*{width}` over a line, done on star runs
+    segments = list(segments)
+    paired = []
+    marks = "*" * (width - 1)
+    i = 0
+    while i < len(segments):
+        kind, value = segments[i]
+        if kind != "stars" or value < width:
+            paired.append(segments[i])
+            i += 1
+            continue
+        rest = value - width
+        if rest >= width:
+            content, close = [], i
+            segments[i] = ("stars", rest)
+        else:
+            close = i + 1
+            while close < len(segments) and not (segments[close][0] == "stars" and segments[close][1] >= width):
+                close += 1
+            if close == len(segments):
+                paired.extend(segments[i:])  # No closing run: nothing later on this line can pair either
+                break
+            content = ([("stars", rest)] if rest else []) + segments[i + 1:close]
+        paired.append(("html", "<b>" + marks))
+        paired.extend(content)
+        paired.append(("html", marks + "</b>"))
+        leftover = segments[close][1] - width
+        if leftover:
+            segments[close] = ("stars", leftover)  # Scanning resumes inside the closing run
+            i = close
+        else:
+            i = close + 1
+    return paired
+
+
+def format_whatsapp_text(text):
+    if SURROGATE_PATTERN.search(text):
+        text = text.encode('utf-16', 'surrogatepass').decode('utf-16')  # Join surrogate pairs
+
+    lines = [[]]
+    for token in WHATSAPP_TOKEN_PATTERN.findall(text):
+        if token == "\n":
+            lines.append([])
+        elif token[0] == "*":
+            lines[-1].append(("stars", len(token)))
+        elif token in WHATSAPP_TOGGLE_LEVELS:
+            lines[-1].append(("toggle", WHATSAPP_TOGGLE_LEVELS[token]))
+        else:
+            lines[-1].append(("text", html.escape(token)))
+
+    parts = []  # Output fragments; "" for a dropped pair
+    kinds = []  # ("text", None), ("open", level), ("close", level) or ("gap", level) for a dropped pair
+    is_open = [False, False, False]
+
+    def toggle(level):
+        if not is_open[level]:
+            is_open[level] = True
+            parts.append(WHATSAPP_TOGGLE_TAGS[level][0])
+            kinds.append(("open", level))
+            return
+        is_open[level] = False
+        j = len(kinds) - 1
+        if j >= 0 and kinds[j][0] == "gap" and kinds[j][1] < level:
+            j -= 1  # Pairs of earlier styles were already gone when this style was resolved
+        if j >= 0 and kinds[j] == ("open", level):
+            del parts[j:], kinds[j:]
+            if kinds and kinds[-1][0] == "gap":
+                kinds[-1] = ("gap", max(kinds[-1][1], level))
+            else:
+                parts.append("")
+                kinds.append(("gap", level))
+        else:
+            parts.append(WHATSAPP_TOGGLE_TAGS[level][1])
+            kinds.append(("close", level))
+
+    for line_number, segments in enumerate(lines):
+        if line_number:
+            parts.append("<br>")
+            kinds.append(("text", None))
+        for width in (4, 3, 2):
+            segments = _pair_star_runs(segments, width)
+        for kind, value in segments:
+            if kind == "stars":
+                for _ in range(value):
+                    toggle(0)
+            elif kind == "toggle":
+                toggle(value)
+            else:
+                parts.append(value)
+                kinds.append(("text", None))
+    return "".join(parts)
+
+
+class RenderCache:
+    # Bounded LRU of formatted message HTML, keyed by a hash of the message text plus the formatter
+    # version. Shared by live display, import replay and HTML export; safe to use from worker threads.
+    FORMATTER_VERSION = 2  # Bump whenever format_whatsapp_text output changes
+
+    def __init__(self, max_entries=2048, max_chars=16_000_000):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.entries = OrderedDict()
+        self.total_chars = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key_for(self, text):
+        digest = hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).hexdigest()
+        return f"{self.FORMATTER_VERSION}:{digest}"
+
+    def format(self, text):
+        key = self.key_for(text)
+        with self.lock:
+            rendered = self.entries.get(key)
+            if rendered is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return rendered
+            self.misses += 1
+        rendered = format_whatsapp_text(text)  # Formatting happens outside the lock
+        with self.lock:
+            if key not in self.entries and len(rendered) <= self.max_chars:
+                self.entries[key] = rendered
+                self.total_chars += len(rendered)
+                while len(self.entries) > self.max_entries or self.total_chars > self.max_chars:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.total_chars -= len(evicted)
+        return rendered
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            hit_rate = (100.0 * self.hits / lookups) if lookups else 0.0
+            return (f"Render cache: {self.hits:,} hits / {self.misses:,} misses ({hit_rate:.1f}% hit rate), "
+                    f"{len(self.entries):,} entries, {self.total_chars:,} chars")
+
+
+# --- Token counting ---
+# Offline estimator modelled on BPE pre-tokenization: words, short digit groups, punctuation runs and
+# whitespace are split the way GPT-style tokenizers split them, then each piece is costed. It needs no
+# vocabulary download and errs on the high side for non-English text.
+TOKEN_PIECE_PATTERN = re.compile(r" ?[A-Za-z]+| ?[0-9]{1,3}| ?[!-/:-@\[-`{-~]+|\s+|[^\x00-\x7f]")
+
+
+def count_tokens(text):
+    tokens = 0
+    for piece in TOKEN_PIECE_PATTERN.findall(text):
+        head = piece.lstrip(" ")[:1] or piece[:1]
+        if head.isascii() and head.isalpha():
+            tokens += (len(piece.lstrip(" ")) + 5) // 6  # Common words are one token, long ones split
+        elif head.isascii() and (head.isdigit() or head.isspace()):
+            tokens += 1
+        elif head.isascii():
+            tokens += (len(piece.lstrip(" ")) + 1) // 2  # Punctuation merges in pairs at best
+        else:
+            tokens += 2 if ord(head) > 0xFFFF else 1  # CJK, emoji and other non-ASCII characters
+    return tokens
+
+
+class TokenCounter:
+    # LRU cache of token counts keyed by text, so the system prompt, chat_log entries and attachments
+    # are only counted once however often the estimate is refreshed.
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.cache = OrderedDict()
+
+    def count(self, text):
+        if not text:
+            return 0
+        tokens = self.cache.get(text)
+        if tokens is None:
+            tokens = count_tokens(text)
+            self.remember(text, tokens)
+        else:
+            self.cache.move_to_end(text)
+        return tokens
+
+    def remember(self, text, tokens):
+        self.cache[text] = tokens
+        self.cache.move_to_end(text)
+        if len(self.cache) > self.max_entries:
+            self.cache.popitem(last=False)
+
+
+# --- Conversation context ---
+class ContextWindowManager:
+    # Builds the `messages` list for a request from chat_log within the model's token budget. Token
+    # counts are cached per chat_log entry and only new entries are counted on each send, so the cost
+    # of a send does not grow with the length of the session.
+    #
+    # The layout is kept friendly to provider-side prompt caching, which only discounts a prefix that
+    # is byte-identical to an earlier request: the system prompt and pinned context come first, then
+    # history from a sticky trim boundary, then the new prompt. When the budget runs out the boundary
+    # jumps forward far enough to leave TRIM_HEADROOM of the budget free, so the following turns
+    # share the same first messages instead of shifting the window by one turn every time.
+    MESSAGE_OVERHEAD_TOKENS = 4  # Role and separators added by the chat format
+    TRIM_HEADROOM = 0.25
+
+    def __init__(self, token_counter, default_budget=16000, model_budgets=None):
+        self.token_counter = token_counter
+        self.default_budget = default_budget
+        self.model_budgets = model_budgets or {}
+        self.chat_log = None
+        self.token_counts = []
+        self.trim_start = 0  # Index of the oldest chat_log entry still sent
+        self.trim_model = None
+
+    def budget_for(self, model):
+        return int(self.model_budgets.get(model, self.default_budget))
+
+    def sync(self, chat_log):
+        # A different list object means the history was replaced (e.g. by an import)
+        if chat_log is not self.chat_log or len(self.token_counts) > len(chat_log):
+            self.chat_log = chat_log
+            self.token_counts = []
+            self.trim_start = 0
+        for entry in chat_log[len(self.token_counts):]:
+            self.token_counts.append(self.token_counter.count(entry[1]) + self.MESSAGE_OVERHEAD_TOKENS)
+
+    @staticmethod
+    def system_content(system_prompt, pinned_context=None):
+        # Pinned_Context may be a string or a list of strings; either way it is appended in a fixed order
+        if isinstance(pinned_context, (list, tuple)):
+            pinned_context = "\n\n".join(str(part) for part in pinned_context if part)
+        if not pinned_context:
+            return system_prompt
+        return f"{system_prompt}\n\n{pinned_context}" if system_prompt else pinned_context
+
+    @staticmethod
+    def is_sent(entry):
+        # Failed requests are shown in the chat but are not part of the conversation
+        return not (entry[0] == "AI" and entry[1].startswith("Error: "))
+
+    def build_messages(self, chat_log, system_prompt, model, pending=(), pinned_context=None):
+        # `pending` holds entries that follow chat_log but are not part of it yet (a queued prompt)
+        self.sync(chat_log)
+        if model != self.trim_model:
+            self.trim_model = model
+            self.trim_start = 0
+        self.trim_start = min(self.trim_start, len(chat_log))
+        budget = self.budget_for(model)
+        system_prompt = self.system_content(system_prompt, pinned_context)
+        used = self.token_counter.count(system_prompt or "") + self.MESSAGE_OVERHEAD_TOKENS
+        used += sum(self.token_counter.count(entry[1]) + self.MESSAGE_OVERHEAD_TOKENS for entry in pending)
+        used += sum(self.token_counts[index] for index in range(self.trim_start, len(chat_log))
+                    if self.is_sent(chat_log[index]))
+        if used > budget:
+            # Oldest turns are dropped first; the latest prompt is always sent
+            keep = 0 if pending else 1
+            target = budget * (1.0 - self.TRIM_HEADROOM)
+            while used > target and self.trim_start < len(chat_log) - keep:
+                if self.is_sent(chat_log[self.trim_start]):
+                    used -= self.token_counts[self.trim_start]
+                self.trim_start += 1
+        history = [{"role": "user" if entry[0] == "You" else "assistant", "content": entry[1]}
+                   for entry in chat_log[self.trim_start:] + list(pending) if self.is_sent(entry)]
+        return [{"role": "system", "content": system_prompt}] + history
+
+
+# --- Chat transcript (model/view) ---
+class ChatRow:
+    # One bubble in the transcript. `html` is built lazily the first time the row is painted.
+    _next_id = 0
+
+    def __init__(self, kind, sender, message, timestamp, html_content=None):
+        ChatRow._next_id += 1
+        self.row_id = ChatRow._next_id  # Stable across prepends, used to key cached layout
+        self.kind = kind  # "user", "ai", "error" or "attachment"
+        self.sender = sender
+        self.message = message
+        self.timestamp = timestamp
+        self.html = html_content
+        self.streaming = False
+        self.note = ""  # Shown after the sender, e.g. when the reply came from the response cache
+        self.details = ""  # Hover text of AI bubbles: timings and token usage of the request
+
+
+def chat_row_for_entry(entry, meta=None):
+    sender, message, timestamp = entry
+    kind = "user" if sender == "You" else "error" if message.startswith("Error: ") else "ai"
+    row = ChatRow(kind, "You" if sender == "You" else "AI", message, timestamp)
+    if meta and kind != "user":
+        row.details = format_reply_details(meta)
+    return row
+
+
+class ChatTranscriptModel(QAbstractListModel):
+    RowRole = Qt.ItemDataRole.UserRole + 1
+
+    def __init__(self, render_cache, parent=None):
+        super().__init__(parent)
+        self.render_cache = render_cache
+        self.rows = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        if role == self.RowRole:
+            return row
+        if role == Qt.ItemDataRole.DisplayRole:
+            return f"{row.timestamp} {row.sender}: {row.message}"
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return row.details or None
+        return None
+
+    def append_row(self, row):
+        position = len(self.rows)
+        self.beginInsertRows(QModelIndex(), position, position)
+        self.rows.append(row)
+        self.endInsertRows()
+        return row
+
+    def insert_row(self, position, row):
+        self.beginInsertRows(QModelIndex(), position, position)
+        self.rows.insert(position, row)
+        self.endInsertRows()
+        return row
+
+    def prepend_rows(self, rows):
+        if not rows:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+        self.rows[:0] = rows
+        self.endInsertRows()
+
+    def update_message(self, row, message, streaming=False):
+        row.message = message
+        row.streaming = streaming
+        row.html = None
+        position = self.row_of(row)
+        if position is not None:
+            index = self.index(position)
+            self.dataChanged.emit(index, index)
+
+    def row_of(self, row):
+        # Rows being updated are almost always at the end, so search backwards
+        for position in range(len(self.rows) - 1, -1, -1):
+            if self.rows[position] is row:
+                return position
+        return None
+
+    def clear(self):
+        self.beginResetModel()
+        self.rows = []
+        self.endResetModel()
+
+    def bubble_html(self, row):
+        if row.html is None:
+            # Partial streaming text is formatted directly so it does not crowd the render cache
+            formatted = format_whatsapp_text(row.message) if row.streaming else self.render_cache.format(row.message)
+            note = f" <i style='color:#555'>({html.escape(row.note)})</i>" if row.note else ""
+            row.html = (f"<p>{html.escape(row.timestamp)} <b>{html.escape(row.sender)}:</b>{note}</p>"
+                        f"<p>{formatted}</p>")
+        return row.html
+
+
+class ChatBubbleDelegate(QStyledItemDelegate):
+    # Paints rows as chat bubbles. Only rows that are actually painted get a laid-out QTextDocument;
+    # every other row reports a cheap estimated height until it scrolls into view, and measured
+    # heights are cached per row and viewport width.
+    BUBBLE_COLORS = {"user": "lightgreen", "ai": "lightblue", "error": "lightcoral", "attachment": "lightyellow"}
+    PADDING = 10
+    MARGIN = 5
+    MAX_WIDTH_RATIO = 0.7
+    DOCUMENT_CACHE_SIZE = 128
+
+    def __init__(self, view, parent=None):
+        super().__init__(parent)
+        self.view = view
+        self.heights = {}  # row_id -> (viewport width, measured height)
+        self.estimates = {}  # row_id -> (viewport width, estimated height) for rows not painted yet
+        self.documents = OrderedDict()  # (row_id, text width) -> QTextDocument for recently painted rows
+
+    def on_rows_changed(self, top_left, bottom_right):
+        # Re-measure changed rows that were already laid out (e.g. a streaming bubble) right away,
+        # so the view relayouts once instead of once for the estimate and again after painting
+        model = self.view.model()
+        for position in range(top_left.row(), bottom_right.row() + 1):
+            row = model.rows[position]
+            old_height = self.heights.pop(row.row_id, None)
+            self.estimates.pop(row.row_id, None)
+            if old_height is not None and self.measure(row) != old_height:
+                self.sizeHintChanged.emit(model.index(position))
+
+    def measure(self, row):
+        width = self.view.viewport().width()
+        document = self.document_for(row, self.text_width(width))
+        self.heights[row.row_id] = (width, int(document.size().height()) + 2 * (self.PADDING + self.MARGIN))
+        return self.heights[row.row_id]
+
+    def clear_cache(self):
+        self.heights.clear()
+        self.estimates.clear()
+        self.documents.clear()
+
+    def text_width(self, width):
+        return max(50, int(width * self.MAX_WIDTH_RATIO) - 2 * self.PADDING)
+
+    def document_for(self, row, text_width):
+        key = (row.row_id, text_width)
+        document = self.documents.get(key)
+        if document is not None and document.property("html") == row.html:
+            self.documents.move_to_end(key)
+            return document
+        document = QTextDocument()
+        document.setDefaultFont(self.view.font())
+        document.setHtml(self.view.model().bubble_html(row))
+        document.setProperty("html", row.html)
+        document.setTextWidth(text_width)
+        ideal_width = document.idealWidth()
+        if ideal_width < text_width - 1:
+            document.setTextWidth(ideal_width + 1)  # Shrink short messages to their content
+        self.documents[key] = document
+        if len(self.documents) > self.DOCUMENT_CACHE_SIZE:
+            self.documents.popitem(last=False)
+        return document
+
+    def bubble_rect(self, row, document, rect):
+        width = document.textWidth() + 2 * self.PADDING
+        height = document.size().height() + 2 * self.PADDING
+        if row.kind in ("user", "attachment"):
+            left = rect.right() - self.MARGIN - width
+        else:
+            left = rect.left() + self.MARGIN
+        return QRectF(left, rect.top() + self.MARGIN, width, height)
+
+    def estimate_height(self, row, width):
+        metrics = self.view.fontMetrics()
+        chars_per_line = max(1, self.text_width(width) // max(1, metrics.averageCharWidth()))
+        lines = 2 + row.message.count("\n") + len(row.message) // chars_per_line
+        return lines * metrics.lineSpacing() + 2 * (self.PADDING + self.MARGIN)
+
+    def sizeHint(self, option, index):
+        # Called for every row on each layout pass, so it avoids the data() round trip
+        row = self.view.model().rows[index.row()]
+        width = option.rect.width() or self.view.viewport().width()
+        cached = self.heights.get(row.row_id) or self.estimates.get(row.row_id)
+        if cached and cached[0] == width:
+            return QSize(width, cached[1])
+        height = self.estimate_height(row, width)
+        self.estimates[row.row_id] = (width, height)
+        return QSize(width, height)
+
+    def paint(self, painter, option, index):
+        row = index.data(ChatTranscriptModel.RowRole)
+        document = self.document_for(row, self.text_width(option.rect.width()))
+        bubble = self.bubble_rect(row, document, QRectF(option.rect))
+
+        painter.save()
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+        color = QColor(self.BUBBLE_COLORS.get(row.kind, "lightblue"))
+        if option.state & QStyle.StateFlag.State_Selected:
+            color = color.darker(120)
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(color)
+        painter.drawRoundedRect(bubble, 10, 10)
+        painter.translate(bubble.left() + self.PADDING, bubble.top() + self.PADDING)
+        document.drawContents(painter)
+        painter.restore()
+
+        # Replace the estimate with the measured height now that the row has been laid out
+        width = self.view.viewport().width()
+        height = int(document.size().height()) + 2 * (self.PADDING + self.MARGIN)
+        if self.heights.get(row.row_id) != (width, height):
+            self.heights[row.row_id] = (width, height)
+            self.sizeHintChanged.emit(index)
+
+    def editorEvent(self, event, model, option, index):
+        # Open links in a bubble the way QTextBrowser.setOpenExternalLinks did
+        if event.type() == QEvent.Type.MouseButtonRelease:
+            row = index.data(ChatTranscriptModel.RowRole)
+            document = self.document_for(row, self.text_width(option.rect.width()))
+            bubble = self.bubble_rect(row, document, QRectF(option.rect))
+            position = event.position() - bubble.topLeft() - QPointF(self.PADDING, self.PADDING)
+            anchor = document.documentLayout().anchorAt(position)
+            if anchor:
+                QDesktopServices.openUrl(QUrl(anchor))
+                return True
+        return super().editorEvent(event, model, option, index)
+
+
+# --- HTML export ---
+def iter_html_chat_log(chat_log, format_text):
+    for entry in chat_log:
+        sender, message, timestamp = entry[0], entry[1], entry[2]
+        formatted_message = format_text(message)
+        if sender == "You":
+            yield f"<div class='message user-message'><p>{html.escape(timestamp)} <b>{html.escape(sender)}:</b></p><p>{formatted_message}</p></div>"
+        elif sender == "AI":
+            yield f"<div class='message ai-message'><p>{html.escape(timestamp)} <b>{html.escape(sender)}:</b></p><p>{formatted_message}</p></div>"
+        else:  # Error messages
+            yield f"<div class='message error-message'><p>{html.escape(timestamp)} <b>{html.escape(sender)}:</b></p><p>{formatted_message}</p></div>"
+
+
+def iter_html_export(chat_log, css_style, format_text):
+    # Yields the exported page in pieces: header, one fragment per message, footer
+    yield f"""
+                <!DOCTYPE html>
+                <html lang="en">
+                <head>
+                    <meta charset="UTF-8">
+                    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+                    <title>WhatsApp Formatter Output</title>
+                    <style>{css_style}</style>
+                </head>
+                <body>
+                    """
+    yield from iter_html_chat_log(chat_log, format_text)
+    yield """
+                </body>
+                </html>
+                """
+
+
+class ChatExportWorker(QThread):
+    # Streams the HTML export straight to disk so the page is never held in memory as a whole. It is
+    # written to a temporary file that replaces the target only once complete, so a failed or
+    # interrupted export never leaves a truncated file behind.
+    progress = pyqtSignal(int)
+    succeeded = pyqtSignal()
+    failed = pyqtSignal(str)
+
+    PROGRESS_EVERY = 100  # Messages between progress updates
+
+    def __init__(self, path, chat_log, css_style, format_text, parent=None):
+        super().__init__(parent)
+        self.path = path
+        self.chat_log = chat_log
+        self.css_style = css_style
+        self.format_text = format_text
+
+    def run(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for count, piece in enumerate(iter_html_export(self.chat_log, self.css_style, self.format_text)):
+                    if self.isInterruptionRequested():
+                        break  # The window is closing
+                    f.write(piece)
+                    if count % self.PROGRESS_EVERY == 0:
+                        self.progress.emit(count)  # The header is piece 0, so count is messages written
+            if self.isInterruptionRequested():
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, self.path)
+            self.succeeded.emit()
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self.failed.emit(str(e))
+
+
+class ChatImportWorker(QThread):
+    # Parses a session file off the GUI thread; the GUI then replays it in batches
+    loaded = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, path, parent=None):
+        super().__init__(parent)
+        self.path = path
+
+    def run(self):
+        # Checked here: the replay runs in GUI slots, where an exception would abort the application
+        try:
+            data = load_session_file(self.path)
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+        if not is_valid_chat_log(data['chat_log']):
+            self.failed.emit("chat_log must be a list of [sender, message, timestamp] entries")
+            return
+        try:
+            for index, meta in data['message_meta'].items():
+                int(index)
+                format_reply_details(meta)
+        except Exception:
+            data['message_meta'] = {}  # Only tooltips depend on it; import the messages without them
+        self.loaded.emit(data)
+
+
+# --- Conversation store ---
+def parse_session_for_index(path):
+    # Runs in a worker process: parse one session file and hash its contents for deduplication
+    try:
+        data = load_session_file(path)
+    except Exception:  # Whatever one file holds, it must not stop the others from being indexed
+        return path, None, None
+    if not isinstance(data, dict) or not is_valid_chat_log(data.get('chat_log')):
+        return path, None, None
+    chat_log = data['chat_log']
+    canonical = json.dumps(chat_log, ensure_ascii=False, separators=(',', ':'))
+    content_hash = hashlib.sha256(canonical.encode('utf-8', 'surrogatepass')).hexdigest()
+    return path, data, content_hash
+
+
+def is_session_file(name):
+    return name.startswith("Chat_") and (name.endswith(".json") or name.endswith(SESSION_JOURNAL_EXT))
+
+
+class ConversationStore:
+    # SQLite index of every session and message in chat_logs/, with an FTS5 table for full-text
+    # search. Sessions are deduplicated by a hash of their chat_log; `indexed_files` remembers the
+    # mtime and size each file had when it was indexed, so unchanged files are never re-read.
+    # A store object (one sqlite3 connection) must only be used from the thread that created it.
+    SCHEMA_VERSION = 3
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.execute("PRAGMA journal_mode = WAL")  # Readers are not blocked by an indexer
+        self.has_fts = True
+        self.create_schema()
+
+    def create_schema(self):
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version < self.SCHEMA_VERSION:
+            # The index only holds data derived from chat_logs/, so older layouts are rebuilt from scratch
+            with self.connection:
+                self.connection.executescript("""
+                    DROP TABLE IF EXISTS messages_fts;
+                    DROP TABLE IF EXISTS messages;
+                    DROP TABLE IF EXISTS indexed_files;
+                    DROP TABLE IF EXISTS sessions;
+                """)
+        with self.connection:
+            self.connection.executescript(f"""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id INTEGER PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    session_name TEXT,
+                    created_at REAL,
+                    message_count INTEGER NOT NULL DEFAULT 0,
+                    content_hash TEXT UNIQUE NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS indexed_files (
+                    path TEXT PRIMARY KEY,
+                    mtime REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    content_hash TEXT
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY,
+                    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+                    seq INTEGER NOT NULL,
+                    sender TEXT,
+                    message TEXT,
+                    timestamp TEXT
+                );
+                CREATE INDEX IF NOT EXISTS messages_by_session ON messages(session_id, seq);
+                CREATE INDEX IF NOT EXISTS indexed_files_by_hash ON indexed_files(content_hash);
+                CREATE INDEX IF NOT EXISTS sessions_by_created ON sessions(created_at DESC, id DESC);
+                PRAGMA user_version = {self.SCHEMA_VERSION};
+            """)
+        try:
+            with self.connection:
+                self.connection.executescript("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+                        USING fts5(message, content='messages', content_rowid='id');
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+                        INSERT INTO messages_fts(rowid, message) VALUES (new.id, new.message);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+                        INSERT INTO messages_fts(messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+                    END;
+                """)
+        except sqlite3.OperationalError:
+            self.has_fts = False  # SQLite built without FTS5: search falls back to LIKE
+
+    def close(self):
+        self.connection.close()
+
+    def file_states(self):
+        return {path: (mtime, size) for path, mtime, size in
+                self.connection.execute("SELECT path, mtime, size FROM indexed_files")}
+
+    def record_file(self, path, mtime, size, data, content_hash):
+        # Must run inside a transaction. Adds the session unless identical content is already indexed.
+        previous = self.connection.execute(
+            "SELECT content_hash FROM indexed_files WHERE path = ?", (path,)).fetchone()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO indexed_files (path, mtime, size, content_hash) VALUES (?, ?, ?, ?)",
+            (path, mtime, size, content_hash))
+        if previous and previous[0] != content_hash:
+            self.drop_orphaned_session(previous[0])
+        if data is None:
+            return False  # Unreadable; remembered so it is only retried once it changes
+        existing = self.connection.execute(
+            "SELECT id FROM sessions WHERE content_hash = ?", (content_hash,)).fetchone()
+        if existing:
+            self.connection.execute("UPDATE sessions SET path = ? WHERE id = ?", (path, existing[0]))
+            return False
+        chat_log = data.get('chat_log', [])
+        cursor = self.connection.execute(
+            "INSERT INTO sessions (path, session_name, created_at, message_count, content_hash) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (path, data.get('session_name') or os.path.splitext(os.path.basename(path))[0],
+             data.get('created_at') or mtime, len(chat_log), content_hash))
+        self.connection.executemany(
+            "INSERT INTO messages (session_id, seq, sender, message, timestamp) VALUES (?, ?, ?, ?, ?)",
+            ((cursor.lastrowid, seq, entry[0], entry[1], entry[2]) for seq, entry in enumerate(chat_log)))
+        return True
+
+    def forget_file(self, path):
+        # Must run inside a transaction
+        row = self.connection.execute("SELECT content_hash FROM indexed_files WHERE path = ?", (path,)).fetchone()
+        self.connection.execute("DELETE FROM indexed_files WHERE path = ?", (path,))
+        if row:
+            self.drop_orphaned_session(row[0])
+
+    def drop_orphaned_session(self, content_hash):
+        if content_hash is None:
+            return
+        survivor = self.connection.execute(
+            "SELECT path FROM indexed_files WHERE content_hash = ? LIMIT 1", (content_hash,)).fetchone()
+        if survivor:
+            self.connection.execute("UPDATE sessions SET path = ? WHERE content_hash = ?", (survivor[0], content_hash))
+        else:
+            self.connection.execute("DELETE FROM sessions WHERE content_hash = ?", (content_hash,))
+
+    def index_file(self, path):
+        # Index a single file on the calling thread (used for the session that was just closed)
+        stat = os.stat(path)
+        _, data, content_hash = parse_session_for_index(path)
+        with self.connection:
+            self.record_file(path, stat.st_mtime, stat.st_size, data, content_hash)
+
+    def search(self, query, limit=200):
+        # Returns (session_id, session_name, seq, sender, timestamp, snippet), best matches first
+        terms = query.split()
+        if not terms:
+            return []
+        if self.has_fts:
+            match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+            return self.connection.execute("""
+                SELECT s.id, s.session_name, m.seq, m.sender, m.timestamp,
+                       snippet(messages_fts, 0, '[', ']', '...', 12)
+                FROM messages_fts
+                JOIN messages m ON m.id = messages_fts.rowid
+                JOIN sessions s ON s.id = m.session_id
+                WHERE messages_fts MATCH ?
+                ORDER BY rank LIMIT ?""", (match, limit)).fetchall()
+        where = " AND ".join("m.message LIKE ?" for _ in terms)
+        return self.connection.execute(f"""
+            SELECT s.id, s.session_name, m.seq, m.sender, m.timestamp, substr(m.message, 1, 120)
+            FROM messages m JOIN sessions s ON s.id = m.session_id
+            WHERE {where} ORDER BY s.created_at DESC LIMIT ?""",
+            [f"%{term}%" for term in terms] + [limit]).fetchall()
+
+    def list_sessions(self, after=None, limit=200):
+        # Session metadata only, newest first; `after` is the (created_at, id) of the last row already listed
+        if after is None:
+            return self.connection.execute("""
+                SELECT id, session_name, created_at, message_count, path FROM sessions
+                ORDER BY created_at DESC, id DESC LIMIT ?""", (limit,)).fetchall()
+        return self.connection.execute("""
+            SELECT id, session_name, created_at, message_count, path FROM sessions
+            WHERE (created_at, id) < (?, ?)
+            ORDER BY created_at DESC, id DESC LIMIT ?""", (after[0], after[1], limit)).fetchall()
+
+    def fetch_messages(self, session_id, before_seq=None, limit=200):
+        # One page of a session, oldest first, ending just before `before_seq` (or at the newest message)
+        if before_seq is None:
+            before_seq = 2 ** 62
+        rows = self.connection.execute("""
+            SELECT seq, sender, message, timestamp FROM messages
+            WHERE session_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?""",
+            (session_id, before_seq, limit)).fetchall()
+        rows.reverse()
+        return rows
+
+
+def reindex_chat_logs(store, log_dir, skip_paths=(), max_workers=None, parallel_threshold=32):
+    """Bring the store in line with log_dir: parse new or changed files (in parallel), drop deleted ones."""
+    started = time.perf_counter()
+    stats = {"scanned": 0, "parsed": 0, "added": 0, "duplicates": 0, "removed": 0, "unchanged": 0}
+    skip_paths = set(skip_paths)
+    known = store.file_states()
+    current = {}
+    if os.path.isdir(log_dir):
+        with os.scandir(log_dir) as entries:
+            for entry in entries:
+                if is_session_file(entry.name) and entry.path not in skip_paths:
+                    stat = entry.stat()
+                    current[entry.path] = (stat.st_mtime, stat.st_size)
+    stats["scanned"] = len(current)
+    changed = sorted(path for path, state in current.items() if known.get(path) != state)
+    stats["unchanged"] = len(current) - len(changed)
+
+    # Parsing and hashing is the expensive part; spread it over processes when there is enough of it.
+    # "spawn" because forking a process that is running Qt and writer threads is not safe.
+    if len(changed) > parallel_threshold:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            results = list(pool.map(parse_session_for_index, changed, chunksize=8))
+    else:
+        results = [parse_session_for_index(path) for path in changed]
+    stats["parsed"] = len(results)
+
+    with store.connection:
+        for path in known.keys() - current.keys():
+            store.forget_file(path)
+            stats["removed"] += 1
+        for path, data, content_hash in results:
+            mtime, size = current[path]
+            if store.record_file(path, mtime, size, data, content_hash):
+                stats["added"] += 1
+            elif data is not None:
+                stats["duplicates"] += 1
+    stats["seconds"] = time.perf_counter() - started
+    return stats
+
+
+def format_index_stats(stats):
+    return (f"History index: {stats['added']} added, {stats['duplicates']} duplicates, "
+            f"{stats['removed']} removed, {stats['unchanged']} unchanged "
+            f"({stats['scanned']} files in {stats['seconds']:.2f}s)")
+
+
+class ChatIndexWorker(QThread):
+    # Runs reindex_chat_logs in the background with its own store connection
+    indexed = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, database_path, log_dir, skip_paths=(), parent=None):
+        super().__init__(parent)
+        self.database_path = database_path
+        self.log_dir = log_dir
+        self.skip_paths = list(skip_paths)
+
+    def run(self):
+        try:
+            store = ConversationStore(self.database_path)
+            try:
+                self.indexed.emit(reindex_chat_logs(store, self.log_dir, self.skip_paths))
+            finally:
+                store.close()
+        except Exception as e:
+            self.failed.emit(str(e))
+
+
+class HistorySearchDialog(QDialog):
+    def __init__(self, parent=None, store=None):
+        super().__init__(parent)
+        self.setWindowTitle("Search History")
+        self.resize(700, 450)
+        self.store = store
+        self.init_ui()
+
+    def init_ui(self):
+        layout = QVBoxLayout(self)
+        self.query_input = QLineEdit(self)
+        self.query_input.setPlaceholderText("Search all chat history...")
+        self.results_list = QListWidget(self)
+        self.status_label = QLabel(self)
+        layout.addWidget(self.query_input)
+        layout.addWidget(self.results_list)
+        layout.addWidget(self.status_label)
+
+        # Search as you type, once typing pauses
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(200)
+        self.search_timer.timeout.connect(self.run_search)
+        self.query_input.textChanged.connect(self.search_timer.start)
+        self.results_list.itemActivated.connect(self.open_result)
+
+    def run_search(self):
+        self.results_list.clear()
+        started = time.perf_counter()
+        results = self.store.search(self.query_input.text())
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        for session_id, session_name, seq, sender, timestamp, snippet in results:
+            item = QListWidgetItem(f"{session_name}  {timestamp} {sender}: {' '.join(snippet.split())}")
+            item.setData(Qt.ItemDataRole.UserRole, (session_id, seq))
+            self.results_list.addItem(item)
+        self.status_label.setText(f"{len(results)} results in {elapsed_ms:.1f} ms")
+
+    def open_result(self, item):
+        session_id, seq = item.data(Qt.ItemDataRole.UserRole)
+        self.parent().open_stored_session(session_id, seq)
+        self.accept()
+
+
+class SessionListModel(QAbstractListModel):
+    # Past sessions for the sidebar, fetched from the store a page at a time as the list is scrolled.
+    # Only metadata is loaded here; messages are read when a session is opened.
+    PAGE_SIZE = 200
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.store = None
+        self.sessions = []  # (id, session_name, created_at, message_count, path)
+        self.exhausted = True
+
+    def set_store(self, store):
+        self.store = store
+        self.refresh()
+
+    def refresh(self):
+        self.beginResetModel()
+        self.sessions = []
+        self.exhausted = self.store is None
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.sessions)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self.exhausted:
+            return
+        after = (self.sessions[-1][2], self.sessions[-1][0]) if self.sessions else None
+        page = self.store.list_sessions(after, self.PAGE_SIZE)
+        if len(page) < self.PAGE_SIZE:
+            self.exhausted = True
+        if page:
+            self.beginInsertRows(QModelIndex(), len(self.sessions), len(self.sessions) + len(page) - 1)
+            self.sessions.extend(page)
+            self.endInsertRows()
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        session_id, session_name, created_at, message_count, path = self.sessions[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            try:
+                created = datetime.datetime.fromtimestamp(created_at).strftime("%Y-%m-%d %H:%M")
+            except (TypeError, ValueError, OverflowError, OSError):
+                created = ""
+            return f"{session_name}\n{created}  ·  {message_count} messages"
+        if role == Qt.ItemDataRole.ToolTipRole:
+            return path
+        if role == Qt.ItemDataRole.UserRole:
+            return session_id
+        return None
 
 
 class EmojiPickerDialog(QDialog):
@@ -66,6 +1206,1141 @@ class EmojiPickerDialog(QDialog):
         # Removed self.accept() to prevent the dialog from closing
 
 
+# --- HTTP connection pool ---
+# httpcore calls the trace hook on the thread that sends the request. A thread that wants per-request
+# timings sets `request_trace.events` to a dict; the pool fills it with the perf_counter() time at which
+# each trace event first fired.
+request_trace = threading.local()
+
+
+class SseTailDrainingStream(httpx.SyncByteStream):
+    # The synchronous SDK closes a streamed completion as soon as it sees "data: [DONE]", before the
+    # chunked-encoding terminator has been read, and httpcore then drops the connection instead of
+    # returning it to the pool. Once [DONE] has gone by, the rest of the body is only that terminator,
+    # so reading it on close is instant and keeps the connection alive. Streams closed early (Stop)
+    # have not seen [DONE] and are closed straight away. Only a "data: [DONE]" line counts: the same
+    # text inside a delta is JSON, where line breaks are escaped, so it never follows a raw newline.
+    DONE_LINE = re.compile(rb'[\r\n]data: ?\[DONE\]')
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.tail = b"\n"  # The body starts at a line boundary
+        self.done_seen = False
+
+    def __iter__(self):
+        for chunk in self.stream:
+            if not self.done_seen:
+                self.done_seen = self.DONE_LINE.search(self.tail + chunk) is not None
+                self.tail = (self.tail + chunk)[-16:]  # A line split across chunks is still found
+            yield chunk
+
+    def close(self):
+        if self.done_seen:
+            try:
+                for _ in self.stream:
+                    pass
+            except httpx.HTTPError:
+                pass
+        self.stream.close()
+
+
+class KeepAliveTransport(httpx.HTTPTransport):
+    def handle_request(self, request):
+        response = super().handle_request(request)
+        if response.headers.get("content-type", "").startswith("text/event-stream"):
+            response.stream = SseTailDrainingStream(response.stream)
+        return response
+
+
+class HttpConnectionPool:
+    # One pooled httpx client shared by every OpenAI client the app creates, so keep-alive connections
+    # and their TLS sessions survive config saves and are reused across turns. New connections and TLS
+    # handshakes are counted through httpcore's "trace" request extension.
+    def __init__(self, max_connections=10, keepalive_expiry=120.0, http2=False):
+        self.settings = (max_connections, keepalive_expiry, http2)
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None  # HTTP/2 needs the optional h2 package
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+        self.tls_handshakes = 0
+        transport = KeepAliveTransport(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                                keepalive_expiry=keepalive_expiry),
+            http2=self.http2
+        )
+        self.client = DefaultHttpxClient(
+            transport=transport,
+            event_hooks={"request": [self.on_request], "response": [self.on_response]}
+        )
+
+    def on_request(self, request):
+        request.extensions["trace"] = self.trace
+
+    def on_response(self, response):
+        with self.lock:
+            self.requests += 1  # Only requests that got an answer, so failed connects do not count as reuse
+
+    def trace(self, event, info):
+        events = getattr(request_trace, "events", None)
+        if events is not None:
+            events.setdefault(event, time.perf_counter())
+        if event == "connection.connect_tcp.complete":
+            with self.lock:
+                self.connections_opened += 1
+        elif event == "connection.start_tls.complete":
+            with self.lock:
+                self.tls_handshakes += 1
+
+    def close(self):
+        self.client.close()
+
+    def stats(self):
+        with self.lock:
+            requests, opened, handshakes = self.requests, self.connections_opened, self.tls_handshakes
+        reused = max(requests - opened, 0)
+        reuse_rate = 100.0 * reused / requests if requests else 0.0
+        return (f"HTTP pool: {requests} requests, {opened} connections opened, {reused} reused "
+                f"({reuse_rate:.0f}%), {handshakes} TLS handshakes, HTTP/2 {'on' if self.http2 else 'off'}")
+
+
+class ConnectionWarmUpWorker(QThread):
+    # Lists each endpoint's models so DNS, TCP and TLS setup happen before the first message.
+    # The connections then stay in the shared pool for that message to reuse.
+    warmed = pyqtSignal(float)  # Seconds taken
+    failed = pyqtSignal(str)
+
+    def __init__(self, clients, parent=None):
+        super().__init__(parent)
+        self.clients = clients
+
+    def run(self):
+        started = time.perf_counter()
+        errors = []
+        for client in self.clients:
+            try:
+                client.with_options(timeout=10.0, max_retries=0).models.list()
+            except APIStatusError:
+                pass  # The endpoint answered (some have no /models), so the connection is open all the same
+            except Exception as e:
+                errors.append(f"{client.base_url}: {e}")
+        if errors:
+            self.failed.emit("; ".join(errors))
+        else:
+            self.warmed.emit(time.perf_counter() - started)
+
+
+# --- Resilience: retries, circuit breakers and hedged requests ---
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Per-endpoint state. Opens after `threshold` consecutive transient failures, then lets a single
+    # trial request through once the cooldown has passed (half-open); its outcome closes or re-opens it.
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.trips = 0
+
+
+class ResilienceLayer:
+    # Shared by every ApiRequestWorker and safe to use from their threads. Settings are plain
+    # attributes so a config save can update them without losing breaker state or latency history.
+    RETRYABLE_STATUS_CODES = (408, 409, 429)
+    LATENCY_SAMPLES = 200
+
+    def __init__(self, max_attempts=4, base_delay=1.0, max_delay=30.0, breaker_threshold=5,
+                 breaker_cooldown=30.0, hedge=False, hedge_percentile=95, hedge_min_samples=20):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.lock = threading.Lock()
+        self.breakers = {}  # endpoint -> CircuitBreaker
+        self.latencies = {}  # (endpoint, stream) -> recent time-to-response samples in seconds
+        self.retries = 0
+        self.hedges_sent = 0
+        self.hedges_won = 0
+
+    # Retries
+    @classmethod
+    def is_transient(cls, error):
+        if isinstance(error, APIConnectionError):  # Includes timeouts
+            return True
+        if isinstance(error, APIStatusError):
+            return error.status_code in cls.RETRYABLE_STATUS_CODES or error.status_code >= 500
+        return False
+
+    @staticmethod
+    def retry_after(error):
+        # Seconds the server asked us to wait, from Retry-After (seconds or HTTP date) or retry-after-ms
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None)
+        if not headers:
+            return None
+        try:
+            if headers.get('retry-after-ms'):
+                return float(headers['retry-after-ms']) / 1000.0
+            value = headers.get('retry-after')
+            if not value:
+                return None
+            try:
+                return max(float(value), 0.0)
+            except ValueError:
+                retry_at = email.utils.parsedate_to_datetime(value)
+                return max((retry_at - datetime.datetime.now(retry_at.tzinfo)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return None
+
+    def retry_delay(self, attempt, error):
+        # Delay before retry number `attempt + 1`, or None when the request should not be retried
+        if attempt + 1 >= self.max_attempts or not self.is_transient(error):
+            return None
+        requested = self.retry_after(error)
+        if requested is not None:
+            return requested if requested <= self.max_delay else None  # Not worth waiting that long
+        # Exponential backoff with full jitter, so queued requests do not retry in lockstep
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def note_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    # Circuit breakers
+    def allow_request(self, endpoint):
+        # Returns None if the request may go ahead, otherwise the seconds until the breaker half-opens
+        with self.lock:
+            breaker = self.breakers.setdefault(endpoint, CircuitBreaker())
+            if breaker.opened_at is None:
+                return None
+            remaining = breaker.opened_at + self.breaker_cooldown - time.monotonic()
+            if remaining <= 0 and not breaker.trial_in_flight:
+                breaker.trial_in_flight = True
+                return None
+            return max(remaining, 0.0)
+
+    def is_open(self, endpoint):
+        # True while the breaker is open and still cooling down; no side effects, unlike allow_request
+        with self.lock:
+            breaker = self.breakers.get(endpoint)
+            if breaker is None or breaker.opened_at is None:
+                return False
+            return breaker.trial_in_flight or time.monotonic() - breaker.opened_at < self.breaker_cooldown
+
+    def record_success(self, endpoint):
+        with self.lock:
+            breaker = self.breakers.setdefault(endpoint, CircuitBreaker())
+            breaker.failures = 0
+            breaker.opened_at = None
+            breaker.trial_in_flight = False
+
+    def record_failure(self, endpoint):
+        with self.lock:
+            breaker = self.breakers.setdefault(endpoint, CircuitBreaker())
+            breaker.failures += 1
+            if breaker.trial_in_flight or breaker.failures >= self.breaker_threshold:
+                if breaker.opened_at is None or breaker.trial_in_flight:
+                    breaker.trips += 1
+                breaker.opened_at = time.monotonic()
+            breaker.trial_in_flight = False
+
+    def release_trial(self, endpoint):
+        # A cancelled request tells nothing about the endpoint: the breaker stays as it was, but a
+        # half-open trial slot it held is given back so the next request can probe
+        with self.lock:
+            breaker = self.breakers.get(endpoint)
+            if breaker is not None:
+                breaker.trial_in_flight = False
+
+    # Hedging
+    def record_latency(self, key, seconds, hedged=False):
+        with self.lock:
+            self.latencies.setdefault(key, deque(maxlen=self.LATENCY_SAMPLES)).append(seconds)
+            if hedged:
+                self.hedges_won += 1
+
+    def hedge_delay(self, key):
+        # The endpoint's recent p95 time-to-response, once there are enough samples to trust it
+        if not self.hedge:
+            return None
+        with self.lock:
+            samples = sorted(self.latencies.get(key, ()))
+        if len(samples) < max(self.hedge_min_samples, 1):
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * self.hedge_percentile / 100))]
+
+    def note_hedge(self):
+        with self.lock:
+            self.hedges_sent += 1
+
+    def stats(self):
+        with self.lock:
+            open_breakers = [endpoint for endpoint, breaker in self.breakers.items() if breaker.opened_at is not None]
+            trips = sum(breaker.trips for breaker in self.breakers.values())
+            text = (f"Resilience: {self.retries} retries, {trips} circuit trips, "
+                    f"{self.hedges_sent} hedged requests ({self.hedges_won} won by the hedge)")
+        if open_breakers:
+            text += f", open: {', '.join(open_breakers)}"
+        return text
+
+
+# --- Client-side rate limiting ---
+RATE_LIMIT_DURATION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+
+
+def parse_rate_limit_reset(value):
+    # "1s", "6m0s", "20ms" (OpenAI) or a plain number of seconds
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    parts = RATE_LIMIT_DURATION_PATTERN.findall(value or "")
+    return sum(float(number) * units[unit] for number, unit in parts) if parts else None
+
+
+class TokenBucket:
+    # Refills continuously at `capacity` per minute. The level may go negative when a request costs
+    # more than was left; later requests then wait until it has refilled.
+    def __init__(self, capacity):
+        self.capacity = float(capacity)
+        self.level = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self.refill(now)
+        needed = min(amount, self.capacity)  # A request bigger than the bucket goes once it is full
+        return 0.0 if self.level >= needed else (needed - self.level) * 60.0 / self.capacity
+
+    def take(self, amount, now):
+        self.refill(now)
+        self.level -= amount
+
+    def sync(self, limit, remaining, reset_seconds, now):
+        # The server's view wins: adopt its remaining budget, and never refill sooner than its reset time
+        if limit:
+            self.capacity = float(limit)
+        self.level = min(float(remaining), self.capacity)
+        if reset_seconds:
+            self.level = min(self.level, self.capacity - reset_seconds * self.capacity / 60.0)
+        self.updated = now
+
+
+class RateLimiter:
+    # Requests-per-minute and tokens-per-minute buckets per (API key, model). Limits start from the
+    # config (0 means unknown) and are corrected from the x-ratelimit-* headers of every response.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.default_limits = (0, 0)  # (RPM, TPM)
+        self.model_limits = {}  # model -> (RPM, TPM)
+        self.buckets = {}  # (api_key, model) -> {"requests": TokenBucket or None, "tokens": TokenBucket or None}
+
+    def configure(self, default_rpm, default_tpm, model_limits):
+        with self.lock:
+            self.default_limits = (int(default_rpm or 0), int(default_tpm or 0))
+            self.model_limits = {model: (int(limits.get('RPM') or 0), int(limits.get('TPM') or 0))
+                                 for model, limits in (model_limits or {}).items()}
+            for (api_key, model), buckets in self.buckets.items():
+                rpm, tpm = self.model_limits.get(model, self.default_limits)
+                # A limit set back to 0 drops the bucket; one the server still enforces is rebuilt
+                # from the headers of the next response
+                for kind, limit in (("requests", rpm), ("tokens", tpm)):
+                    if not limit:
+                        buckets[kind] = None
+                    elif buckets[kind] is None:
+                        buckets[kind] = TokenBucket(limit)
+                    else:
+                        buckets[kind].capacity = float(limit)
+
+    def buckets_for(self, api_key, model):
+        # Must be called with the lock held
+        buckets = self.buckets.get((api_key, model))
+        if buckets is None:
+            rpm, tpm = self.model_limits.get(model, self.default_limits)
+            buckets = {"requests": TokenBucket(rpm) if rpm else None, "tokens": TokenBucket(tpm) if tpm else None}
+            self.buckets[(api_key, model)] = buckets
+        return buckets
+
+    def wait_time(self, api_key, model, tokens):
+        now = time.monotonic()
+        with self.lock:
+            buckets = self.buckets_for(api_key, model)
+            return max(buckets["requests"].wait_time(1, now) if buckets["requests"] else 0.0,
+                       buckets["tokens"].wait_time(tokens, now) if buckets["tokens"] else 0.0)
+
+    def acquire(self, api_key, model, tokens):
+        now = time.monotonic()
+        with self.lock:
+            buckets = self.buckets_for(api_key, model)
+            if buckets["requests"]:
+                buckets["requests"].take(1, now)
+            if buckets["tokens"]:
+                buckets["tokens"].take(tokens, now)
+
+    def update_from_headers(self, api_key, model, headers):
+        if not headers:
+            return
+        now = time.monotonic()
+        with self.lock:
+            buckets = self.buckets_for(api_key, model)
+            for kind in ("requests", "tokens"):
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                if remaining is None and kind == "requests":
+                    remaining = headers.get("x-ratelimit-remaining")  # OpenRouter and others: requests only
+                if remaining is None:
+                    continue
+                try:
+                    remaining = float(remaining)
+                    limit = float(headers.get(f"x-ratelimit-limit-{kind}") or headers.get("x-ratelimit-limit") or 0)
+                except ValueError:
+                    continue
+                reset = parse_rate_limit_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+                if buckets[kind] is None:
+                    if not limit:
+                        continue
+                    buckets[kind] = TokenBucket(limit)
+                buckets[kind].sync(limit, remaining, reset, now)
+
+    def remaining(self, api_key, model):
+        # ((requests left, RPM) or None, (tokens left, TPM) or None)
+        now = time.monotonic()
+        with self.lock:
+            buckets = self.buckets_for(api_key, model)
+            result = []
+            for kind in ("requests", "tokens"):
+                bucket = buckets[kind]
+                if bucket:
+                    bucket.refill(now)
+                result.append((max(bucket.level, 0.0), bucket.capacity) if bucket else None)
+            return tuple(result)
+
+    def describe(self, api_key, model):
+        # "12/500 requests, 30000/90000 tokens", or "" while no limit is known
+        parts = []
+        for budget, kind in zip(self.remaining(api_key, model), ("requests", "tokens")):
+            if budget:
+                parts.append(f"{int(budget[0])}/{int(budget[1])} {kind}")
+        return ", ".join(parts)
+
+    def stats(self):
+        with self.lock:
+            keys = list(self.buckets)
+        budgets = [(model, self.describe(api_key, model)) for api_key, model in keys]
+        return "Rate limits: " + ("; ".join(f"{model}: {budget} left" for model, budget in budgets if budget)
+                                  or "none known")
+
+
+# --- Endpoint routing ---
+router_log = logging.getLogger("ai_chat_app.router")
+
+
+class Endpoint:
+    # One configured API endpoint and its rolling health as seen by the EndpointRouter
+    def __init__(self, url, api_key, client):
+        self.url = url
+        self.api_key = api_key
+        self.client = client
+        self.latency = None  # Moving average of time-to-response in seconds; None until it has answered
+        self.error_rate = 0.0  # Moving average of transient failures, 0..1
+        self.requests = 0
+
+    def host(self):
+        return urlparse(self.url).netloc or self.url
+
+    def describe(self):
+        latency = "untried" if self.latency is None else f"{self.latency * 1000:.0f} ms"
+        return f"{self.host()} ({latency}, {self.error_rate:.0%} errors)"
+
+
+class EndpointRouter:
+    # Sends each request to the fastest healthy endpoint configured for its model. Models without an
+    # Endpoints entry use API_Url/API_Key. Health comes from exponentially weighted moving averages of
+    # latency and error rate, plus the ResilienceLayer's circuit breakers. Untried endpoints rank first
+    # so that every endpoint gets measured, and endpoints with rate-limit budget left rank before
+    # those that would make the request wait.
+    EWMA_ALPHA = 0.2
+
+    def __init__(self, resilience, rate_limiter, max_error_rate=0.5):
+        self.resilience = resilience
+        self.rate_limiter = rate_limiter
+        self.max_error_rate = max_error_rate
+        self.lock = threading.Lock()
+        self.endpoints = {}  # (url, api_key) -> Endpoint; kept across config saves with their statistics
+        self.routes = {}  # model -> [(Endpoint, model name to send)]
+        self.default_endpoint = None
+
+    def configure(self, api_url, api_key, endpoints_config, make_client):
+        # endpoints_config: {model: [{API_Url, API_Key, Model (optional)}, ...]}
+        with self.lock:
+            known = self.endpoints
+            self.endpoints = {}
+
+            def endpoint_for(url, key):
+                endpoint = known.get((url, key)) or Endpoint(url, key, None)
+                endpoint.client = make_client(url, key)
+                self.endpoints[(url, key)] = endpoint
+                return endpoint
+
+            self.default_endpoint = endpoint_for(api_url, api_key) if api_url and api_key else None
+            self.routes = {}
+            for model, entries in (endpoints_config or {}).items():
+                route = []
+                for entry in entries or []:
+                    url = entry.get('API_Url') or api_url
+                    key = entry.get('API_Key') or api_key
+                    if url and key:
+                        route.append((endpoint_for(url, key), entry.get('Model') or model))
+                if route:
+                    self.routes[model] = route
+
+    def route_for(self, model):
+        if model in self.routes:
+            return self.routes[model]
+        return [(self.default_endpoint, model)] if self.default_endpoint else []
+
+    def candidates(self, model, exclude=(), tokens=0):
+        # Best first: healthy endpoints by latency, then unhealthy ones by error rate. Endpoints whose
+        # circuit breaker is open are left out.
+        with self.lock:
+            route = [(endpoint, name) for endpoint, name in self.route_for(model)
+                     if endpoint.url not in exclude and not self.resilience.is_open(endpoint.url)]
+        healthy = [choice for choice in route if choice[0].error_rate <= self.max_error_rate]
+        unhealthy = [choice for choice in route if choice[0].error_rate > self.max_error_rate]
+        throttled = {choice[0]: self.rate_limiter.wait_time(choice[0].api_key, choice[1], tokens) > 0
+                     for choice in route}
+        healthy.sort(key=lambda choice: (throttled[choice[0]], choice[0].latency or 0.0))
+        unhealthy.sort(key=lambda choice: (throttled[choice[0]], choice[0].error_rate))
+        return healthy + unhealthy
+
+    def reserve(self, model, tokens):
+        # Charges the request to the best endpoint with budget left and returns (endpoint, 0.0). Without
+        # budget anywhere nothing is charged and the result is (None, seconds until budget is back).
+        waits = []
+        for endpoint, name in self.candidates(model, tokens=tokens):
+            wait = self.rate_limiter.wait_time(endpoint.api_key, name, tokens)
+            if wait <= 0:
+                self.rate_limiter.acquire(endpoint.api_key, name, tokens)
+                return endpoint, 0.0
+            waits.append(wait)
+        return None, min(waits) if waits else 0.0
+
+    def choose(self, model, exclude=(), tokens=0):
+        ranked = self.candidates(model, exclude, tokens)
+        if not ranked:
+            return None
+        endpoint, name = ranked[0]
+        if len(ranked) > 1 or exclude:
+            router_log.info("Routing %s to %s as %s; other candidates: %s%s", model, endpoint.describe(), name,
+                            ", ".join(other.describe() for other, _ in ranked[1:]) or "none",
+                            f"; already failed: {', '.join(sorted(exclude))}" if exclude else "")
+        else:
+            router_log.debug("Routing %s to %s as %s", model, endpoint.describe(), name)
+        return endpoint, name
+
+    def record(self, endpoint, latency=None, failed=False):
+        with self.lock:
+            endpoint.requests += 1
+            endpoint.error_rate += self.EWMA_ALPHA * ((1.0 if failed else 0.0) - endpoint.error_rate)
+            if latency is not None:
+                endpoint.latency = latency if endpoint.latency is None else \
+                    endpoint.latency + self.EWMA_ALPHA * (latency - endpoint.latency)
+
+    def stats(self):
+        with self.lock:
+            endpoints = list(self.endpoints.values())
+        return "Endpoints: " + ("; ".join(f"{endpoint.describe()}, {endpoint.requests} requests"
+                                          for endpoint in endpoints) or "none")
+
+
+# --- Response cache ---
+class ResponseCache:
+    # Opt-in SQLite cache of completed replies, keyed by a hash of everything that decides the answer:
+    # endpoint, upstream model, temperature and the exact messages sent. Entries expire after `ttl`
+    # seconds and the least recently used ones are evicted beyond `max_entries`. GUI thread only.
+    def __init__(self, path, ttl=86400, max_entries=1000):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        with self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS responses_by_last_used ON responses(last_used);
+            """)
+
+    @staticmethod
+    def key(endpoint_url, model, temperature, messages):
+        payload = json.dumps([endpoint_url, model, float(temperature), messages],
+                             ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, keys):
+        # First live entry for any of the keys (one per endpoint the request could be routed to)
+        now = time.time()
+        for key in keys:
+            row = self.connection.execute("SELECT response, created_at FROM responses WHERE key = ?",
+                                          (key,)).fetchone()
+            if row is None:
+                continue
+            with self.connection:
+                if now - row[1] > self.ttl:
+                    self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    continue
+                self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+        self.misses += 1
+        return None
+
+    def put(self, key, model, response):
+        now = time.time()
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?)", (key, model, response, now, now))
+            expired = self.connection.execute("DELETE FROM responses WHERE created_at < ?",
+                                              (now - self.ttl,)).rowcount
+            evicted = self.connection.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)).rowcount
+        self.evictions += expired + evicted
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM responses")
+
+    def close(self):
+        self.connection.close()
+
+    def stats(self):
+        entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return (f"Response cache: {self.hits} hits / {self.misses} misses ({rate:.1f}% hit rate), "
+                f"{entries} entries, {self.evictions} evicted")
+
+
+SEMANTIC_WORD_PATTERN = re.compile(r"\w+")
+
+
+def semantic_vector(text, dimensions):
+    # Hashed TF vector of a prompt: words, word pairs and character trigrams of the lower-cased words,
+    # so whitespace, punctuation and small rewordings barely move it. Signed hashing keeps collisions
+    # from adding up. Weighted by IDF at query time.
+    words = SEMANTIC_WORD_PATTERN.findall(text.lower())
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    for word in words:
+        padded = f" {word} "
+        features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+    vector = np.zeros(dimensions, dtype=np.float32)
+    for feature in features:
+        digest = zlib.crc32(feature.encode("utf-8"))
+        vector[digest % dimensions] += 1.0 if digest & 0x80000000 else -1.0
+    return np.sign(vector) * np.log1p(np.abs(vector))  # Sublinear term frequency
+
+
+class SemanticCache:
+    # Near-duplicate companion of ResponseCache, stored in the same database. Prompts are only compared
+    # within a scope (model, temperature and every message before the prompt), so a reply is never
+    # reused for a different conversation. Vectors live in one preallocated NumPy array; a lookup is a
+    # single matrix-vector product. GUI thread only.
+    DIMENSIONS = 2048
+    MAX_PROMPT_CHARS = 2000  # Longer prompts (attachments) are too specific to match approximately
+
+    def __init__(self, connection, threshold=0.9, ttl=86400, max_entries=1000):
+        self.connection = connection
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS similar_responses (
+                    id INTEGER PRIMARY KEY,
+                    scope TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+        rows = self.connection.execute(
+            "SELECT id, scope, vector, created_at, last_used FROM similar_responses").fetchall()
+        self.reset(max(len(rows), 64))
+        for row_id, scope, vector, created_at, last_used in rows:
+            self.append(row_id, scope, np.frombuffer(vector, dtype=np.float32), created_at, last_used)
+
+    def reset(self, capacity):
+        self.count = 0
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.scopes = [None] * capacity
+        self.vectors = np.zeros((capacity, self.DIMENSIONS), dtype=np.float32)
+        self.created = np.zeros(capacity)
+        self.used = np.zeros(capacity)
+        self.document_frequency = np.zeros(self.DIMENSIONS)
+
+    @staticmethod
+    def scope(model, temperature, messages):
+        payload = json.dumps([model, float(temperature), messages[:-1]],
+                             ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def append(self, row_id, scope, vector, created_at, last_used):
+        if self.count == len(self.ids):  # Grow by doubling
+            capacity = 2 * len(self.ids)
+            self.ids = np.resize(self.ids, capacity)
+            self.scopes.extend([None] * (capacity - len(self.scopes)))
+            self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+            self.created = np.resize(self.created, capacity)
+            self.used = np.resize(self.used, capacity)
+        position = self.count
+        self.ids[position] = row_id
+        self.scopes[position] = scope
+        self.vectors[position] = vector
+        self.created[position] = created_at
+        self.used[position] = last_used
+        self.document_frequency += vector != 0
+        self.count += 1
+
+    def remove(self, position):
+        # Swap the last entry into the hole
+        self.document_frequency -= self.vectors[position] != 0
+        last = self.count - 1
+        for array in (self.ids, self.vectors, self.created, self.used):
+            array[position] = array[last]
+        self.scopes[position] = self.scopes[last]
+        self.scopes[last] = None
+        self.count -= 1
+
+    def best_match(self, scope, vector):
+        # (position, cosine similarity) of the closest live prompt in the scope, or (None, 0.0)
+        candidates = [position for position in range(self.count) if self.scopes[position] == scope]
+        if not candidates or not vector.any():
+            return None, 0.0
+        candidates = np.array(candidates)
+        idf = np.log((1.0 + self.count) / (1.0 + self.document_frequency)) + 1.0
+        matrix = self.vectors[candidates] * idf
+        query = vector * idf
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+        similarities = (matrix @ query) / np.maximum(norms, 1e-12)
+        similarities[self.created[candidates] < time.time() - self.ttl] = -1.0  # Expired
+        best = int(np.argmax(similarities))
+        return int(candidates[best]), float(similarities[best])
+
+    def get(self, scope, prompt):
+        # (reply, similarity) for the closest earlier prompt above the threshold, or None
+        if len(prompt) > self.MAX_PROMPT_CHARS:
+            return None
+        position, similarity = self.best_match(scope, semantic_vector(prompt, self.DIMENSIONS))
+        if position is None or similarity < self.threshold:
+            self.misses += 1
+            return None
+        now = time.time()
+        self.used[position] = now
+        with self.connection:
+            self.connection.execute("UPDATE similar_responses SET last_used = ? WHERE id = ?",
+                                    (now, int(self.ids[position])))
+        row = self.connection.execute("SELECT response FROM similar_responses WHERE id = ?",
+                                      (int(self.ids[position]),)).fetchone()
+        self.hits += 1
+        return row[0], similarity
+
+    def put(self, scope, prompt, response):
+        if len(prompt) > self.MAX_PROMPT_CHARS:
+            return
+        vector = semantic_vector(prompt, self.DIMENSIONS)
+        if not vector.any():
+            return
+        now = time.time()
+        position, similarity = self.best_match(scope, vector)
+        with self.connection:
+            if position is not None and similarity > 0.999:  # Same prompt again: refresh its reply
+                self.connection.execute("DELETE FROM similar_responses WHERE id = ?", (int(self.ids[position]),))
+                self.remove(position)
+            cursor = self.connection.execute(
+                "INSERT INTO similar_responses (scope, response, vector, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?)", (scope, response, vector.tobytes(), now, now))
+            self.append(cursor.lastrowid, scope, vector, now, now)
+            self.evict(now)
+
+    def evict(self, now):
+        # Expired entries first, then the least recently used beyond max_entries
+        stale = [position for position in range(self.count) if self.created[position] < now - self.ttl]
+        excess = self.count - len(stale) - self.max_entries
+        if excess > 0:
+            live = [position for position in np.argsort(self.used[:self.count]) if position not in stale]
+            stale.extend(int(position) for position in live[:excess])
+        if not stale:
+            return
+        self.connection.executemany("DELETE FROM similar_responses WHERE id = ?",
+                                    [(int(self.ids[position]),) for position in stale])
+        for position in sorted(stale, reverse=True):
+            self.remove(position)
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM similar_responses")
+        self.reset(64)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return (f"Semantic cache: {self.hits} hits / {self.misses} misses ({rate:.1f}% hit rate), "
+                f"{self.count} prompts, threshold {self.threshold:.2f}")
+
+
+class PendingRequest:
+    # One sent prompt in the request queue, from the moment it is shown until its reply is committed
+    def __init__(self, user_entry, user_row, bypass_cache=False):
+        self.user_entry = user_entry
+        self.user_row = user_row  # Transcript row of the prompt; the reply bubble is placed under it
+        self.bypass_cache = bypass_cache  # Always ask the API; the fresh reply still replaces the cached one
+        self.cache_checked = False  # The caches are consulted once, on the first dispatch attempt
+        self.reply_entry = None
+        self.reply_meta = None  # Timings and token usage of the reply, kept apart from the entry
+        self.done = False
+        self.worker = None
+        self.ai_row = None
+        self.streaming = False
+        self.stream_text = ""
+
+
+def usage_summary(usage):
+    # Token counts from an OpenAI-style usage object. Providers report prompt-cache hits differently:
+    # OpenAI as prompt_tokens_details.cached_tokens, DeepSeek as prompt_cache_hit_tokens.
+    if usage is None:
+        return None
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details else None
+    if cached is None:
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    return {"prompt_tokens": usage.prompt_tokens or 0, "completion_tokens": usage.completion_tokens or 0,
+            "cached_tokens": cached or 0}
+
+
+def connection_timings(events, started):
+    # Milliseconds spent on DNS + TCP connect and TLS, and until the response headers arrived, from
+    # the trace events of one attempt. Connect and TLS are None when a pooled connection was reused;
+    # httpcore resolves DNS inside connect_tcp, so the two are reported together.
+    def span(name):
+        start, end = events.get(f"connection.{name}.started"), events.get(f"connection.{name}.complete")
+        return round((end - start) * 1000) if start is not None and end is not None else None
+    headers = [moment for event, moment in events.items() if event.endswith(".receive_response_headers.complete")]
+    return {"connect_ms": span("connect_tcp"), "tls_ms": span("start_tls"),
+            "ttfb_ms": round((min(headers) - started) * 1000) if headers else None}
+
+
+def format_reply_details(meta):
+    # Tooltip text for an AI bubble from the metadata stored for its chat_log entry
+    timing, usage = meta.get("timing") or {}, meta.get("usage") or {}
+    lines = []
+    if timing.get("model"):
+        lines.append(f"{timing['model']} via {timing.get('endpoint') or 'default endpoint'}")
+    if timing:
+        if timing.get("connect_ms") is None:
+            lines.append("Connection: reused")
+        else:
+            tls = f" (TLS {timing['tls_ms']} ms)" if timing.get("tls_ms") is not None else ""
+            lines.append(f"Connection: DNS + connect {timing['connect_ms']} ms{tls}")
+        firsts = [f"{label} {timing[key]:,} ms" for label, key in (("first byte", "ttfb_ms"),
+                                                                   ("first token", "ttft_ms"))
+                  if timing.get(key) is not None]
+        if firsts:
+            lines.append("Time to " + ", ".join(firsts))
+        total = f"Total {timing['total_ms'] / 1000.0:.2f} s"
+        if timing.get("tokens_per_second"):
+            total += f", {timing['tokens_per_second']:.1f} tokens/s"
+        if timing.get("attempts", 1) > 1 or timing.get("hedged"):
+            total += f", {timing.get('attempts', 1)} attempts{' (hedged)' if timing.get('hedged') else ''}"
+        lines.append(total)
+    if usage:
+        cached = f" ({usage['cached_tokens']:,} cached)" if usage.get("cached_tokens") else ""
+        lines.append(f"Tokens: {usage['prompt_tokens']:,} prompt{cached}, {usage['completion_tokens']:,} completion")
+    return "\n".join(lines)
+
+
+class ApiRequestWorker(QThread):
+    # Runs a single chat completion off the GUI thread and reports back via signals.
+    # cancel() may be called from the GUI thread; a cancelled worker emits nothing further.
+    # Each attempt goes to the endpoint the EndpointRouter picks. A transient failure fails over to the
+    # next endpoint straight away; once every endpoint has failed, the ResilienceLayer's backoff applies
+    # before the next round. Nothing is retried once text has been shown, and slow requests may be hedged.
+    response_ready = pyqtSignal(str)
+    request_failed = pyqtSignal(str)
+    delta_received = pyqtSignal(str)  # Coalesced streaming text, at most one emit per flush interval
+    retrying = pyqtSignal(str)
+
+    def __init__(self, router, resilience, model, messages, temperature, stream=False, flush_interval_ms=50,
+                 prompt_tokens=0, reserved=None, stream_usage=True, parent=None):
+        super().__init__(parent)
+        self.router = router
+        self.resilience = resilience
+        self.rate_limiter = router.rate_limiter
+        self.model = model
+        self.messages = messages
+        self.prompt_tokens = prompt_tokens  # Estimate, charged against the endpoint's tokens-per-minute budget
+        self.reserved = reserved  # Endpoint the dispatcher already charged for this request
+        self.temperature = temperature
+        self.stream = stream
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.stream_usage = stream_usage  # Ask for the usage chunk at the end of a stream
+        self.usage = None  # usage_summary() of the reply, set before response_ready is emitted
+        self.timing = {}  # Timings of the reply for format_reply_details, also set before response_ready
+        self.started = None
+        self.first_token_at = None
+        self.attempts = 0
+        self.endpoint = None  # Endpoint of the current attempt
+        self.upstream_model = model  # Model name the current endpoint knows the model by
+        self.cancel_event = threading.Event()
+        self.response_stream = None
+        self.delivered_text = False  # Once text is on screen the request can no longer be retried
+
+    def cancel(self):
+        self.cancel_event.set()
+        # Closing the HTTP response ends a stream at once and tells the server to stop generating
+        stream = self.response_stream
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception:
+                pass
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def run(self):
+        try:
+            self.started = time.perf_counter()
+            content = self.run_with_retries()
+            if not self.is_cancelled():
+                self.finish_timing(content)
+                self.response_ready.emit(content)
+        except Exception as e:
+            if not self.is_cancelled():  # Closing the stream surfaces as a read error; that is expected
+                self.request_failed.emit(str(e))
+
+    def run_with_retries(self):
+        attempt = 0
+        failed = set()  # Endpoints that failed in the current round
+        blocked = set()  # Endpoints whose circuit breaker refused this request
+        while True:
+            choice = self.router.choose(self.model, exclude=failed | blocked, tokens=self.prompt_tokens)
+            if choice is None:
+                raise CircuitOpenError(f"No endpoint is available for {self.model}; every configured endpoint is "
+                                       f"failing repeatedly or not configured")
+            self.endpoint, self.upstream_model = choice
+            if self.resilience.allow_request(self.endpoint.url) is not None:
+                blocked.add(self.endpoint.url)  # Another request is already probing it
+                continue
+            if self.endpoint is self.reserved:
+                self.reserved = None  # Charged by the dispatcher; only the first attempt uses it
+            else:
+                # Retries and failovers are charged here, waiting if the endpoint has no budget left
+                wait = self.rate_limiter.wait_time(self.endpoint.api_key, self.upstream_model, self.prompt_tokens)
+                if wait > 0:
+                    self.retrying.emit(f"Waiting {wait:.1f}s for the rate limit of {self.endpoint.describe()}")
+                    if self.cancel_event.wait(wait):
+                        self.resilience.release_trial(self.endpoint.url)
+                        return ""
+                self.rate_limiter.acquire(self.endpoint.api_key, self.upstream_model, self.prompt_tokens)
+            try:
+                content = self.run_streaming() if self.stream else self.run_completion()
+            except Exception as e:
+                if self.is_cancelled():
+                    self.resilience.release_trial(self.endpoint.url)
+                    raise
+                transient = ResilienceLayer.is_transient(e)
+                self.router.record(self.endpoint, failed=transient)
+                self.rate_limiter.update_from_headers(self.endpoint.api_key, self.upstream_model,
+                                                      getattr(getattr(e, 'response', None), 'headers', None))
+                if transient:
+                    self.resilience.record_failure(self.endpoint.url)
+                else:
+                    self.resilience.record_success(self.endpoint.url)  # The endpoint answered; the request was bad
+                if not transient or self.delivered_text or attempt + 1 >= self.resilience.max_attempts:
+                    raise
+                attempt += 1
+                self.resilience.note_retry()
+                failed.add(self.endpoint.url)
+                alternatives = self.router.candidates(self.model, exclude=failed | blocked)
+                if alternatives:
+                    router_log.warning("%s failed for %s (%s); failing over", self.endpoint.describe(), self.model, e)
+                    self.retrying.emit(f"Request failed: {e} - trying {alternatives[0][0].describe()}")
+                    continue
+                delay = self.resilience.retry_delay(attempt - 1, e)
+                if delay is None:
+                    raise
+                failed.clear()  # Start a new round over every endpoint after the backoff
+                self.retrying.emit(f"Request failed: {e} - retrying in {delay:.1f}s "
+                                   f"(attempt {attempt + 1} of {self.resilience.max_attempts})")
+                if self.cancel_event.wait(delay):
+                    return ""
+                continue
+            if self.is_cancelled():
+                self.resilience.release_trial(self.endpoint.url)  # Stopped, not answered: no verdict
+            else:
+                self.resilience.record_success(self.endpoint.url)
+            return content
+
+    def start_request(self, **options):
+        # The request runs on helper threads so Stop never waits on a blocked read. With hedging on, a
+        # duplicate is sent once the first has taken longer than the endpoint's p95, to the next best
+        # endpoint if there is one. The first response wins; the loser is closed (streams) or ignored.
+        # Returns None if cancelled.
+        hedge_after = self.resilience.hedge_delay((self.endpoint.url, self.stream))
+        results = queue.Queue()
+
+        def attempt(endpoint, model, hedged):
+            started = time.perf_counter()
+            request_trace.events = events = {}
+            try:
+                raw = endpoint.client.chat.completions.with_raw_response.create(
+                    model=model,
+                    messages=self.messages,
+                    temperature=self.temperature,
+                    **options
+                )
+                self.rate_limiter.update_from_headers(endpoint.api_key, model, raw.headers)
+                response = raw.parse()
+                results.put((endpoint, model, hedged, time.perf_counter() - started, response, None,
+                             connection_timings(events, started)))
+            except Exception as e:
+                results.put((endpoint, model, hedged, None, None, e, None))
+            finally:
+                request_trace.events = None
+
+        self.attempts += 1
+        threading.Thread(target=attempt, args=(self.endpoint, self.upstream_model, False), daemon=True).start()
+        outstanding = 1
+        hedge_at = None if hedge_after is None else time.monotonic() + hedge_after
+        while True:
+            if self.is_cancelled():
+                self.discard_responses(results, outstanding)
+                return None
+            timeout = 0.1 if hedge_at is None else min(0.1, max(hedge_at - time.monotonic(), 0.0))
+            try:
+                endpoint, model, hedged, seconds, response, error, timings = results.get(timeout=timeout)
+            except queue.Empty:
+                if hedge_at is not None and time.monotonic() >= hedge_at:
+                    hedge_at = None
+                    outstanding += 1
+                    self.resilience.note_hedge()
+                    alternatives = self.router.candidates(self.model, exclude={self.endpoint.url})
+                    target = alternatives[0] if alternatives else (self.endpoint, self.upstream_model)
+                    router_log.info("Hedging %s request to %s", self.model, target[0].describe())
+                    threading.Thread(target=attempt, args=(target[0], target[1], True), daemon=True).start()
+                continue
+            outstanding -= 1
+            if error is None:
+                self.endpoint, self.upstream_model = endpoint, model
+                self.resilience.record_latency((endpoint.url, self.stream), seconds, hedged)
+                self.router.record(endpoint, latency=seconds)
+                self.timing = dict(timings, hedged=hedged)
+                self.discard_responses(results, outstanding)
+                return response
+            if not outstanding:
+                self.endpoint, self.upstream_model = endpoint, model  # The failure is charged to this endpoint
+                raise error
+            hedge_at = None  # One attempt failed; let the other one finish rather than hedging again
+
+    @staticmethod
+    def discard_responses(results, outstanding):
+        def close_late_responses():
+            for _ in range(outstanding):
+                response = results.get()[4]
+                if hasattr(response, 'close'):
+                    response.close()
+        if outstanding:
+            threading.Thread(target=close_late_responses, daemon=True).start()
+
+    def finish_timing(self, content):
+        # Total and time to first token count from the start of the worker, so they include rate-limit
+        # waits and retries; first byte is measured on the attempt that answered
+        finished = time.perf_counter()
+        first_token = self.first_token_at or finished  # A non-streamed reply arrives all at once
+        completion_tokens = (self.usage or {}).get("completion_tokens") or count_tokens(content)
+        generating = finished - first_token
+        if generating < 0.05:  # Not streamed, or the whole reply arrived in one burst
+            generating = finished - self.started
+        self.timing.update({
+            "endpoint": self.endpoint.host() if self.endpoint else None,
+            "model": self.upstream_model,
+            "stream": self.stream,
+            "attempts": self.attempts,
+            "ttft_ms": round((first_token - self.started) * 1000),
+            "total_ms": round((finished - self.started) * 1000),
+            "tokens_per_second": round(completion_tokens / generating, 1) if generating > 0 else None,
+        })
+
+    def run_completion(self):
+        completion = self.start_request()
+        if completion is None:
+            return ""
+        self.usage = usage_summary(completion.usage)
+        return completion.choices[0].message.content or ""
+
+    def run_streaming(self):
+        options = {"stream_options": {"include_usage": True}} if self.stream_usage else {}
+        stream = self.start_request(stream=True, **options)
+        if stream is None:
+            return ""
+        self.response_stream = stream
+        if self.is_cancelled():
+            stream.close()  # Stop arrived while the request was being sent
+            return ""
+        parts = []
+        pending = []
+        last_flush = time.monotonic()
+        for chunk in stream:
+            if self.is_cancelled():
+                break
+            if chunk.usage:
+                self.usage = usage_summary(chunk.usage)  # Sent in a final chunk without choices
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if self.first_token_at is None:
+                self.first_token_at = time.perf_counter()
+            parts.append(delta)
+            pending.append(delta)
+            now = time.monotonic()
+            if now - last_flush >= self.flush_interval:
+                self.delivered_text = True
+                self.delta_received.emit("".join(pending))
+                pending = []
+                last_flush = now
+        if pending:
+            self.delivered_text = True
+            self.delta_received.emit("".join(pending))
+        return "".join(parts)
+
+
 class AIChatApp(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -74,22 +2349,56 @@ class AIChatApp(QMainWindow):
         self.setGeometry(100, 100, 800, 600)
 
         self.chat_log = []
+        self.message_meta = {}  # chat_log index -> timings and token usage of that AI reply
         self.config = self.load_config()
-        self.session_log_file = None  # Initialize session_log_file
+        self.render_cache = RenderCache(
+            max_entries=int((self.config or {}).get('Render_Cache_Entries', 2048)),
+            max_chars=int((self.config or {}).get('Render_Cache_Max_Chars', 16_000_000))
+        )
+        self.token_counter = TokenCounter()
+        self.context_manager = ContextWindowManager(self.token_counter)
+        self.apply_context_config()
+        self.resilience = ResilienceLayer()  # Retries, circuit breakers and hedging for API requests
+        self.rate_limiter = RateLimiter()  # Client-side RPM/TPM budgets per API key and model
+        self.router = EndpointRouter(self.resilience, self.rate_limiter)  # Picks the endpoint for each request
+        self.apply_resilience_config()
+        self.session_log_writer = None  # Background writer for the session journal
+        self.session_log_messages = 0  # "message" records journalled; chat_log may also hold imported entries
+        self.session_log_path = None
 
         self.emoji_dialog = EmojiPickerDialog(self, None)
         self.attached_file_content = None
         self.attached_file_name = None
+        self.attached_file_tokens = 0
+        self.pending_requests = []  # Sent prompts not yet committed to chat_log, oldest first
+        self.waiting_requests = deque()  # Prompts waiting for a free request slot
+        self.running_requests = []
+        self.stopped_workers = set()  # Cancelled workers that have not exited yet
+        self.usage_totals = {"replies": 0, "prompt_tokens": 0, "cached_tokens": 0}  # Replies that reported usage
+        self.import_worker = None
+        self.export_worker = None
+        self.history_store = None  # ConversationStore used from the GUI thread
+        self.response_cache = None  # ResponseCache while Response_Cache is enabled
+        self.semantic_cache = None  # SemanticCache sharing its database, while Semantic_Cache is enabled
+        self.index_worker = None
+        self.paged_session = None  # (session_id, oldest loaded seq) while a stored session is shown
+        self.replay_entries = []  # chat_log entries still waiting to be shown, replayed newest first
+        self.replay_total = 0
         self.init_ui()
         self.emoji_dialog.input_box = self.input_box
+        self.update_token_estimate()
 
         self.openai_client = None
+        self.http_pool = None  # Shared by every OpenAI client; see shared_http_pool
+        self.warm_up_worker = None
         if (self.config):
             self.init_openai_client()  # Initialize if config exists
         else:
             QMessageBox.warning(self, "API Configuration", "API configuration not found.  Please configure the API.")
 
         self.create_session_log()  # Create session log after config load
+        self.open_history_store()
+        self.apply_response_cache_config()
 
         self.css_style = """
                     body {
@@ -125,40 +2434,142 @@ class AIChatApp(QMainWindow):
                     .emoji { font-size: 1.2em; }
                 """
 
+    def apply_context_config(self):
+        if self.config:
+            self.context_manager.default_budget = int(self.config.get('Context_Token_Budget', 16000))
+            self.context_manager.model_budgets = self.config.get('Context_Budgets') or {}
+
+    def apply_resilience_config(self):
+        if self.config:
+            self.resilience.max_attempts = max(1, int(self.config.get('Retry_Max_Attempts', 4)))
+            self.resilience.base_delay = float(self.config.get('Retry_Base_Delay', 1.0))
+            self.resilience.max_delay = float(self.config.get('Retry_Max_Delay', 30.0))
+            self.resilience.breaker_threshold = max(1, int(self.config.get('Circuit_Breaker_Threshold', 5)))
+            self.resilience.breaker_cooldown = float(self.config.get('Circuit_Breaker_Cooldown', 30.0))
+            self.resilience.hedge = bool(self.config.get('Hedge_Requests', False))
+            self.resilience.hedge_percentile = float(self.config.get('Hedge_Percentile', 95))
+            self.resilience.hedge_min_samples = int(self.config.get('Hedge_Min_Samples', 20))
+            self.rate_limiter.configure(self.config.get('Rate_Limit_RPM'), self.config.get('Rate_Limit_TPM'),
+                                        self.config.get('Rate_Limits'))
+
     def init_openai_client(self):
         if self.config and self.config.get('API_Key') and self.config.get('API_Url'):
-            self.openai_client = OpenAI(
-                api_key=self.config['API_Key'],
-                base_url=self.config['API_Url']
-            )
+            self.openai_client = self.create_openai_client(self.config['API_Url'], self.config['API_Key'])
+            self.router.max_error_rate = float(self.config.get('Router_Max_Error_Rate', 0.5))
+            self.router.configure(self.config['API_Url'], self.config['API_Key'],
+                                  self.config.get('Endpoints'), self.create_openai_client)
+            self.warm_up_connection()
         else:
             self.openai_client = None
 
+    def create_openai_client(self, api_url, api_key):
+        return OpenAI(
+            api_key=api_key,
+            base_url=api_url,
+            http_client=self.shared_http_pool().client,
+            max_retries=0  # Retries are handled by the ResilienceLayer
+        )
+
+    def warm_up_clients(self):
+        return [endpoint.client for endpoint, _ in self.router.route_for(self.config.get('Model'))]
+
+    def shared_http_pool(self):
+        # Reused across config saves; only rebuilt when the pool settings themselves change
+        settings = (int(self.config.get('HTTP_Pool_Size', 10)),
+                    float(self.config.get('HTTP_Keepalive_Expiry', 120)),
+                    bool(self.config.get('HTTP2', False)))
+        if self.http_pool is None or self.http_pool.settings != settings:
+            if self.http_pool is not None and not self.running_requests:
+                self.http_pool.close()  # Otherwise the old pool is left to finish its requests
+            self.http_pool = HttpConnectionPool(*settings)
+        return self.http_pool
+
+    def warm_up_connection(self):
+        # Opt-in: pays DNS, TCP and TLS setup in the background instead of on the first message
+        if not self.config.get('HTTP_Warm_Up', False) or self.warm_up_worker:
+            return
+        self.warm_up_worker = ConnectionWarmUpWorker(self.warm_up_clients(), parent=self)
+        self.warm_up_worker.warmed.connect(
+            lambda seconds: self.statusBar().showMessage(f"Connected to API in {seconds * 1000:.0f} ms", 3000))
+        self.warm_up_worker.failed.connect(
+            lambda error: self.statusBar().showMessage(f"Could not reach API: {error}", 10000))
+        self.warm_up_worker.finished.connect(self.on_warm_up_worker_finished)
+        self.warm_up_worker.start()
+
+    def on_warm_up_worker_finished(self):
+        clients = self.warm_up_worker.clients
+        self.warm_up_worker.deleteLater()
+        self.warm_up_worker = None
+        if self.openai_client and clients != self.warm_up_clients():
+            self.warm_up_connection()  # The config changed while warming up; warm the new endpoints too
+
     def init_ui(self):
         # --- Menu Bar ---
         menu_bar = QMenuBar(self)
         self.setMenuBar(menu_bar)
 
         file_menu = menu_bar.addMenu("File")
-        settings_menu = menu_bar.addMenu("Settings")
-
-        export_action = QAction("Export Chat History", self)
-        export_action.triggered.connect(self.export_chat_history)
-        file_menu.addAction(export_action)
 
-        import_action = QAction("Import Chat History", self)
-        import_action.triggered.connect(self.import_chat_history)
-        file_menu.addAction(import_action)
+        self.export_action = QAction("Export Chat History", self)  # Disabled while an export is running
+        self.export_action.triggered.connect(self.export_chat_history)
+        file_menu.addAction(self.export_action)
+
+        self.import_action = QAction("Import Chat History", self)  # Disabled while a file is being parsed
+        self.import_action.triggered.connect(self.import_chat_history)
+        file_menu.addAction(self.import_action)
+
+        history_menu = menu_bar.addMenu("History")
+        search_action = QAction("Search History...", self)
+        search_action.triggered.connect(self.show_history_search)
+        history_menu.addAction(search_action)
+        reindex_action = QAction("Refresh History Index", self)
+        reindex_action.triggered.connect(self.start_history_indexing)
+        history_menu.addAction(reindex_action)
+        self.clear_cache_action = QAction("Clear Response Cache", self)
+        self.clear_cache_action.triggered.connect(self.clear_response_cache)
+        history_menu.addAction(self.clear_cache_action)
 
+        settings_menu = menu_bar.addMenu("Settings")
         config_action = QAction("API Configuration", self)
         config_action.triggered.connect(self.show_config_dialog)
         settings_menu.addAction(config_action)
 
+        stats_action = QAction("Performance Statistics", self)
+        stats_action.triggered.connect(self.show_performance_stats)
+        settings_menu.addAction(stats_action)
+
         # --- Chat Display Area ---
-        self.chat_browser = QTextBrowser(self)
-        self.chat_browser.setOpenExternalLinks(True)
-        self.chat_browser.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
-        self.chat_browser.customContextMenuRequested.connect(self.show_chat_context_menu)
+        # A virtualized list: only visible bubbles are laid out, so long sessions stay responsive
+        self.transcript = ChatTranscriptModel(self.render_cache, self)
+        self.chat_view = QListView(self)
+        self.chat_view.setModel(self.transcript)
+        self.chat_delegate = ChatBubbleDelegate(self.chat_view, self)
+        self.chat_view.setItemDelegate(self.chat_delegate)
+        self.chat_view.setUniformItemSizes(False)
+        self.chat_view.setResizeMode(QListView.ResizeMode.Adjust)
+        self.chat_view.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.chat_view.setSelectionMode(QAbstractItemView.SelectionMode.ExtendedSelection)
+        self.chat_view.setStyleSheet("QListView { background-color: #e5ddd5; }")
+        self.chat_view.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
+        self.chat_view.customContextMenuRequested.connect(self.show_chat_context_menu)
+        self.transcript.dataChanged.connect(self.chat_delegate.on_rows_changed)
+        self.transcript.modelReset.connect(self.chat_delegate.clear_cache)
+        # Stay pinned to the newest message while estimated heights are replaced by measured ones
+        self.follow_chat_bottom = True
+        scroll_bar = self.chat_view.verticalScrollBar()
+        scroll_bar.rangeChanged.connect(
+            lambda minimum, maximum: scroll_bar.setValue(maximum) if self.follow_chat_bottom else None)
+        self.scroll_to_bottom_timer = QTimer(self)
+        self.scroll_to_bottom_timer.setSingleShot(True)
+        self.scroll_to_bottom_timer.setInterval(0)
+        self.scroll_to_bottom_timer.timeout.connect(self.chat_view.scrollToBottom)
+        # Only user scrolling (wheel, drag, arrows) changes what we follow; layout changes do not
+        scroll_bar.actionTriggered.connect(lambda action: QTimer.singleShot(0, self.on_chat_scrolled))
+        copy_shortcut = QAction(self.chat_view)
+        copy_shortcut.setShortcut(QKeySequence.StandardKey.Copy)
+        copy_shortcut.setShortcutContext(Qt.ShortcutContext.WidgetShortcut)
+        copy_shortcut.triggered.connect(self.copy_selected_messages)
+        self.chat_view.addAction(copy_shortcut)
 
         # --- Input Area ---
         self.input_box = QTextEdit(self)
@@ -169,38 +2580,140 @@ class AIChatApp(QMainWindow):
         self.input_box.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
         self.input_box.customContextMenuRequested.connect(self.show_input_context_menu)
 
+        # Imported history is shown in batches from the newest message backwards
+        self.replay_timer = QTimer(self)
+        self.replay_timer.setInterval(0)  # Runs whenever the event loop is idle
+        self.replay_timer.timeout.connect(self.replay_next_batch)
+        self.replay_progress = QProgressBar(self)
+        self.replay_progress.setMaximumWidth(200)
+        self.replay_progress.setFormat("Loading history %p%")
+        self.replay_progress.hide()
+        self.statusBar().addPermanentWidget(self.replay_progress)
+        self.export_progress = QProgressBar(self)
+        self.export_progress.setMaximumWidth(200)
+        self.export_progress.setFormat("Exporting %p%")
+        self.export_progress.hide()
+        self.statusBar().addPermanentWidget(self.export_progress)
+
+        self.queue_label = QLabel(self)
+        self.queue_label.hide()
+        self.statusBar().addPermanentWidget(self.queue_label)
+        # Queued prompts held back by the rate limiter are re-checked when budget is expected back
+        self.rate_limit_timer = QTimer(self)
+        self.rate_limit_timer.setSingleShot(True)
+        self.rate_limit_timer.timeout.connect(self.dispatch_requests)
+        self.rate_limited = False
+
+        # Remaining rate-limit budget of the current model, once any limit is known
+        self.rate_label = QLabel(self)
+        self.rate_label.hide()
+        self.statusBar().addPermanentWidget(self.rate_label)
+        self.rate_label_timer = QTimer(self)
+        self.rate_label_timer.setInterval(1000)
+        self.rate_label_timer.timeout.connect(self.update_rate_limit_status)
+        self.rate_label_timer.start()
+
+        # Token estimate for the pending prompt, refreshed shortly after typing pauses
+        self.token_label = QLabel(self)
+        self.statusBar().addPermanentWidget(self.token_label)
+        self.token_estimate_timer = QTimer(self)
+        self.token_estimate_timer.setSingleShot(True)
+        self.token_estimate_timer.setInterval(150)
+        self.token_estimate_timer.timeout.connect(self.update_token_estimate)
+        self.input_box.textChanged.connect(self.token_estimate_timer.start)
+
         self.attach_button = QPushButton("Attach File", self)
         self.attach_button.clicked.connect(self.attach_file)
         self.emojis_button = QPushButton("Emojis", self)
         self.emojis_button.clicked.connect(self.show_emoji_picker)
         self.send_button = QPushButton("Send", self)
         self.send_button.clicked.connect(self.send_message)
+        self.stop_button = QPushButton("Stop", self)  # Shown while requests are running or queued
+        self.stop_button.clicked.connect(self.stop_request)
+        self.stop_button.hide()
+        self.bypass_cache_checkbox = QCheckBox("Skip cache", self)  # Applies to the next message only
+        self.bypass_cache_checkbox.setToolTip("Send the next message to the API even if a cached reply exists")
+        self.bypass_cache_checkbox.hide()
 
         # Input layout
         input_hbox = QHBoxLayout()
         input_hbox.addWidget(self.input_box)
         input_hbox.addWidget(self.attach_button)
         input_hbox.addWidget(self.emojis_button)
+        input_hbox.addWidget(self.bypass_cache_checkbox)
         input_hbox.addWidget(self.send_button)
+        input_hbox.addWidget(self.stop_button)
 
         # Main layout
         main_layout = QVBoxLayout()
-        main_layout.addWidget(self.chat_browser)
+        main_layout.addWidget(self.chat_view)
         main_layout.addLayout(input_hbox)
 
         central_widget = QWidget()
         central_widget.setLayout(main_layout)
         self.setCentralWidget(central_widget)
 
+        # --- Session Browser ---
+        # Past sessions from the history index; rows are fetched as the list scrolls
+        self.session_list_model = SessionListModel(self)
+        self.session_list = QListView(self)
+        self.session_list.setModel(self.session_list_model)
+        self.session_list.setUniformItemSizes(True)
+        self.session_list.activated.connect(
+            lambda index: self.open_stored_session(index.data(Qt.ItemDataRole.UserRole)))
+        self.session_dock = QDockWidget("Sessions", self)
+        self.session_dock.setObjectName("session_dock")
+        self.session_dock.setWidget(self.session_list)
+        self.addDockWidget(Qt.DockWidgetArea.LeftDockWidgetArea, self.session_dock)
+        self.session_dock.hide()
+        session_browser_action = self.session_dock.toggleViewAction()
+        session_browser_action.setText("Session Browser")
+        session_browser_action.setShortcut(QKeySequence("Ctrl+B"))
+        history_menu.insertAction(search_action, session_browser_action)
+
+    # --- Token Estimate ---
+    def pending_prompt_tokens(self):
+        return self.token_counter.count(self.input_box.toPlainText()) + self.attached_file_tokens
+
+    def prompt_token_limit(self):
+        # Room left for the new message once the system prompt is in place
+        if not self.config:
+            return None
+        model = self.config.get('Model')
+        system_tokens = self.token_counter.count(ContextWindowManager.system_content(
+            self.config.get('System_Prompt'), self.config.get('Pinned_Context')) or "")
+        return self.context_manager.budget_for(model) - system_tokens - 2 * ContextWindowManager.MESSAGE_OVERHEAD_TOKENS
+
+    def update_token_estimate(self):
+        tokens = self.pending_prompt_tokens()
+        limit = self.prompt_token_limit()
+        text = f"Prompt: ~{tokens:,} tokens"
+        if self.attached_file_tokens:
+            text += f" (attachment ~{self.attached_file_tokens:,})"
+        if limit is not None:
+            text += f" / {limit:,}"
+            self.token_label.setStyleSheet("color: red;" if tokens > limit else "")
+        self.token_label.setText(text)
+
     def show_emoji_picker(self):
         self.emoji_dialog.show()
 
     # --- Context Menus for Copy/Paste ---
     def show_chat_context_menu(self, position):
+        index = self.chat_view.indexAt(position)
+        if index.isValid() and not self.chat_view.selectionModel().isSelected(index):
+            self.chat_view.setCurrentIndex(index)  # Right-click acts on the bubble under the cursor
         menu = QMenu(self)
         copy_action = menu.addAction("Copy")
-        copy_action.triggered.connect(self.chat_browser.copy)
-        menu.popup(self.chat_browser.viewport().mapToGlobal(position))
+        copy_action.triggered.connect(self.copy_selected_messages)
+        select_all_action = menu.addAction("Select All")
+        select_all_action.triggered.connect(self.chat_view.selectAll)
+        menu.popup(self.chat_view.viewport().mapToGlobal(position))
+
+    def copy_selected_messages(self):
+        indexes = sorted(self.chat_view.selectionModel().selectedIndexes(), key=lambda index: index.row())
+        if indexes:
+            QApplication.clipboard().setText("\n\n".join(index.data() for index in indexes))
 
     def show_input_context_menu(self, position):
         menu = QMenu(self)
@@ -216,56 +2729,202 @@ class AIChatApp(QMainWindow):
 
     # --- File Menu Actions ---
     def export_chat_history(self):
+        if self.export_worker:
+            return  # One export at a time
         file_name, _ = QFileDialog.getSaveFileName(self, "Export Chat", "", "HTML Files (*.html)")
         if file_name:
-            try:
-                html_content = self.generate_html_chat_log()
-                full_html = f"""
-                <!DOCTYPE html>
-                <html lang="en">
-                <head>
-                    <meta charset="UTF-8">
-                    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                    <title>WhatsApp Formatter Output</title>
-                    <style>{self.css_style}</style>
-                </head>
-                <body>
-                    {html_content}
-                </body>
-                </html>
-                """
-                with open(file_name, 'w', encoding='utf-8') as f:
-                    f.write(full_html)
-                QMessageBox.information(self, "Export Successful", "Chat history exported to HTML.")
-            except Exception as e:
-                QMessageBox.critical(self, "Export Error", f"Could not export chat history: {e}")
+            # Written piece by piece on a worker thread from a snapshot of the current log
+            worker = ChatExportWorker(file_name, list(self.chat_log), self.css_style, self.format_whatsapp_text, self)
+            worker.progress.connect(self.export_progress.setValue)
+            worker.succeeded.connect(
+                lambda: QMessageBox.information(self, "Export Successful", "Chat history exported to HTML."))
+            worker.failed.connect(
+                lambda error: QMessageBox.critical(self, "Export Error", f"Could not export chat history: {error}"))
+            worker.finished.connect(lambda worker=worker: self.on_export_finished(worker))
+            self.export_worker = worker
+            self.export_action.setEnabled(False)
+            self.export_progress.setRange(0, max(1, len(self.chat_log)))
+            self.export_progress.setValue(0)
+            self.export_progress.show()
+            worker.start()
+
+    def on_export_finished(self, worker):
+        worker.deleteLater()
+        if self.export_worker is worker:
+            self.export_worker = None
+            self.export_progress.hide()
+            self.export_action.setEnabled(True)
 
     def generate_html_chat_log(self):
-        html_log = ""
-        for sender, message, timestamp in self.chat_log:
-            formatted_message = self.format_whatsapp_text(message)
-            if sender == "You":
-                html_log += f"<div class='message user-message'><p>{html.escape(timestamp)} <b>{html.escape(sender)}:</b></p><p>{formatted_message}</p></div>"
-            elif sender == "AI":
-                html_log += f"<div class='message ai-message'><p>{html.escape(timestamp)} <b>{html.escape(sender)}:</b></p><p>{formatted_message}</p></div>"
-            else:  # Error messages
-                html_log += f"<div class='message error-message'><p>{html.escape(timestamp)} <b>{html.escape(sender)}:</b></p><p>{formatted_message}</p></div>"
-        return html_log
+        return "".join(iter_html_chat_log(self.chat_log, self.format_whatsapp_text))
 
     def import_chat_history(self):
-        file_name, _ = QFileDialog.getOpenFileName(self, "Import Chat", "", "JSON Files (*.json)")
+        if self.import_worker:
+            return  # One import at a time
+        file_name, _ = QFileDialog.getOpenFileName(self, "Import Chat", "", "Chat Logs (*.json *.jsonl)")
         if file_name:
+            # Parsing happens on a worker thread; the transcript fills in as batches are replayed
+            worker = ChatImportWorker(file_name, self)
+            worker.loaded.connect(self.on_chat_history_loaded)
+            worker.failed.connect(
+                lambda error: QMessageBox.critical(self, "Import Error", f"Could not import chat history: {error}"))
+            worker.finished.connect(lambda worker=worker: self.on_import_finished(worker))
+            self.import_worker = worker
+            self.import_action.setEnabled(False)
+            self.statusBar().showMessage(f"Reading {os.path.basename(file_name)}...")
+            worker.start()
+
+    def on_import_finished(self, worker):
+        worker.deleteLater()
+        if self.import_worker is worker:
+            self.import_worker = None
+            self.import_action.setEnabled(True)
+
+    def on_chat_history_loaded(self, data):
+        self.load_chat_history(data.get('chat_log', []), data.get('message_meta'))
+
+    def load_chat_history(self, chat_log, message_meta=None):
+        self.paged_session = None
+        self.chat_log = chat_log
+        self.message_meta = {int(index): meta for index, meta in (message_meta or {}).items()}
+        self.transcript.clear()
+        self.replay_entries = list(chat_log)
+        self.replay_total = len(chat_log)
+        self.replay_progress.setRange(0, max(1, self.replay_total))
+        self.replay_progress.setValue(0)
+        self.replay_progress.show()
+        self.scroll_chat_to_bottom()
+        self.replay_next_batch()  # The most recent messages are visible right away
+        if self.replay_entries:
+            self.replay_timer.start()
+
+    def replay_next_batch(self, first_batch_size=200):
+        # Batches double in size: the newest messages show at once, and a long history needs only
+        # a handful of relayouts of the view
+        loaded = self.replay_total - len(self.replay_entries)
+        batch_size = max(first_batch_size, loaded)
+        batch = self.replay_entries[-batch_size:]
+        del self.replay_entries[-batch_size:]
+        first_index = len(self.replay_entries)  # chat_log index of the first entry in the batch
+        self.transcript.prepend_rows([chat_row_for_entry(entry, self.message_meta.get(first_index + offset))
+                                      for offset, entry in enumerate(batch)])
+        self.replay_progress.setValue(self.replay_total - len(self.replay_entries))
+        if not self.replay_entries:
+            self.replay_timer.stop()
+            self.replay_progress.hide()
+            self.statusBar().showMessage(f"Chat history imported: {self.replay_total:,} messages.", 5000)
+
+    # --- History Store ---
+    def history_database_path(self):
+        return (self.config or {}).get('History_Database', os.path.join("chat_logs", "history.db"))
+
+    def apply_response_cache_config(self):
+        config = self.config or {}
+        path = config.get('Response_Cache_Database', os.path.join("chat_logs", "response_cache.db"))
+        if self.response_cache and (not config.get('Response_Cache') or self.response_cache.path != path):
+            self.semantic_cache = None
+            self.response_cache.close()
+            self.response_cache = None
+        if config.get('Response_Cache') and not self.response_cache:
             try:
-                with open(file_name, 'r') as f:
-                    data = json.load(f)
-                    self.chat_log = data.get('chat_log', [])
-                    self.chat_browser.clear()
-                    for entry in self.chat_log:
-                        sender, message, timestamp = entry
-                        self.display_message(sender, message, timestamp)  # Use display_message
-                QMessageBox.information(self, "Import Successful", "Chat history imported from JSON.")
+                self.response_cache = ResponseCache(path)
             except Exception as e:
-                QMessageBox.critical(self, "Import Error", f"Could not import chat history: {e}")
+                self.statusBar().showMessage(f"Response cache unavailable: {e}", 10000)
+        if not config.get('Semantic_Cache') or not self.response_cache:
+            self.semantic_cache = None
+        elif np is None:
+            self.statusBar().showMessage("The semantic cache needs NumPy; only exact matches are cached.", 10000)
+        elif not self.semantic_cache:
+            self.semantic_cache = SemanticCache(self.response_cache.connection)
+        for cache in (self.response_cache, self.semantic_cache):
+            if cache:
+                cache.ttl = float(config.get('Response_Cache_TTL', 86400))
+                cache.max_entries = max(1, int(config.get('Response_Cache_Entries', 1000)))
+        if self.semantic_cache:
+            self.semantic_cache.threshold = float(config.get('Semantic_Cache_Threshold', 0.9))
+        self.bypass_cache_checkbox.setVisible(self.response_cache is not None)
+        self.clear_cache_action.setEnabled(self.response_cache is not None)
+
+    def clear_response_cache(self):
+        if self.response_cache:
+            self.response_cache.clear()
+            if self.semantic_cache:
+                self.semantic_cache.clear()
+            self.statusBar().showMessage("Response cache cleared.", 5000)
+
+    def open_history_store(self):
+        try:
+            self.history_store = ConversationStore(self.history_database_path())
+        except Exception as e:
+            self.statusBar().showMessage(f"History index unavailable: {e}", 10000)
+            return
+        self.session_list_model.set_store(self.history_store)
+        self.start_history_indexing()
+
+    def start_history_indexing(self):
+        # Pick up sessions written or changed since the last run, without the live journal of this session
+        if self.index_worker or not self.history_store:
+            return
+        self.index_worker = ChatIndexWorker(self.history_database_path(), "chat_logs",
+                                            skip_paths=[self.session_log_path], parent=self)
+        self.index_worker.indexed.connect(self.on_history_indexed)
+        self.index_worker.failed.connect(
+            lambda error: self.statusBar().showMessage(f"History indexing failed: {error}", 10000))
+        self.index_worker.finished.connect(self.on_index_worker_finished)
+        self.index_worker.start()
+
+    def on_history_indexed(self, stats):
+        if stats["parsed"] or stats["removed"]:
+            self.statusBar().showMessage(format_index_stats(stats), 10000)
+            self.session_list_model.refresh()
+
+    def on_index_worker_finished(self):
+        self.index_worker.deleteLater()
+        self.index_worker = None
+
+    def show_history_search(self):
+        if not self.history_store:
+            QMessageBox.warning(self, "Search History", "The history index is not available.")
+            return
+        HistorySearchDialog(self, self.history_store).exec()
+
+    def open_stored_session(self, session_id, focus_seq=None, page_size=200):
+        # Shows a session from the store one page at a time; older pages load when scrolled to the top
+        self.replay_timer.stop()
+        self.replay_entries = []
+        self.replay_progress.hide()
+        rows = self.history_store.fetch_messages(session_id, limit=page_size)
+        while focus_seq is not None and rows and rows[0][0] > focus_seq:
+            rows = self.history_store.fetch_messages(session_id, before_seq=rows[0][0], limit=page_size) + rows
+        self.chat_log = [[sender, message, timestamp] for _, sender, message, timestamp in rows]
+        self.message_meta = {}  # The history store keeps the messages only
+        self.transcript.clear()
+        self.transcript.prepend_rows([chat_row_for_entry(entry) for entry in self.chat_log])
+        self.paged_session = (session_id, rows[0][0]) if rows else None
+        if focus_seq is not None and rows:
+            self.follow_chat_bottom = False
+            focus_index = self.transcript.index(focus_seq - rows[0][0])
+            self.chat_view.setCurrentIndex(focus_index)
+            # Scroll once the view has laid the new rows out
+            QTimer.singleShot(0, lambda: self.chat_view.scrollTo(
+                focus_index, QAbstractItemView.ScrollHint.PositionAtCenter))
+        else:
+            self.scroll_chat_to_bottom()
+
+    def load_older_page(self, page_size=200):
+        session_id, oldest_seq = self.paged_session
+        rows = self.history_store.fetch_messages(session_id, before_seq=oldest_seq, limit=page_size)
+        if not rows:
+            self.paged_session = None  # Reached the start of the session
+            return
+        entries = [[sender, message, timestamp] for _, sender, message, timestamp in rows]
+        self.chat_log = entries + self.chat_log  # A new list, so the context manager recounts
+        self.message_meta = {index + len(entries): meta for index, meta in self.message_meta.items()}
+        self.paged_session = (session_id, rows[0][0])
+        scroll_bar = self.chat_view.verticalScrollBar()
+        distance_from_bottom = scroll_bar.maximum() - scroll_bar.value()
+        self.transcript.prepend_rows([chat_row_for_entry(entry) for entry in entries])
+        scroll_bar.setValue(scroll_bar.maximum() - distance_from_bottom)  # Keep the same messages in view
 
     # --- Settings Menu Actions and Configuration ---
     def load_config(self):
@@ -304,18 +2963,24 @@ class AIChatApp(QMainWindow):
             QMessageBox.warning(self, "Configuration Error",
                                 f"Model '{model}' is not in the list of suggested models. Please ensure it's a valid model for your API endpoint.")
 
-        config = {
+        # Start from the loaded config so settings not shown in the dialog are preserved
+        config = dict(self.config) if self.config else {}
+        config.update({
             'API_Url': api_url,
             'API_Key': api_key,
             'Model': model,
             'System_Prompt': system_prompt,
             'Temperature': temperature_val
-        }
+        })
         try:
             with open('api_configuration.yaml', 'w') as file:
                 yaml.dump(config, file)
             self.config = config
+            self.apply_context_config()
+            self.apply_resilience_config()
+            self.apply_response_cache_config()
             self.init_openai_client()
+            self.update_token_estimate()
             QMessageBox.information(self, "Configuration Saved", "API configuration saved successfully.")
             return True
         except Exception as e:
@@ -366,6 +3031,27 @@ class AIChatApp(QMainWindow):
 
         dialog.exec()
 
+    def performance_stats(self):
+        # One line per subsystem; shown in the Performance Statistics dialog
+        stats = [self.render_cache.stats()]
+        if self.http_pool:
+            stats.append(self.http_pool.stats())
+        stats.append(self.resilience.stats())
+        stats.append(self.router.stats())
+        stats.append(self.rate_limiter.stats())
+        if self.response_cache:
+            stats.append(self.response_cache.stats())
+        if self.semantic_cache:
+            stats.append(self.semantic_cache.stats())
+        totals = self.usage_totals
+        rate = 100.0 * totals["cached_tokens"] / totals["prompt_tokens"] if totals["prompt_tokens"] else 0.0
+        stats.append(f"Provider prompt cache: {totals['cached_tokens']:,} of {totals['prompt_tokens']:,} prompt "
+                     f"tokens cached ({rate:.1f}%) over {totals['replies']} replies")
+        return stats
+
+    def show_performance_stats(self):
+        QMessageBox.information(self, "Performance Statistics", "\n".join(self.performance_stats()))
+
     # --- File Attachment ---
     def attach_file(self):
         file_name, _ = QFileDialog.getOpenFileName(self, "Attach File", "", "All Files (*)")
@@ -379,6 +3065,8 @@ class AIChatApp(QMainWindow):
                     preview += "...\n[Preview limited to first 500 characters]"
                 self.attached_file_content = content
                 self.attached_file_name = file_name
+                self.attached_file_tokens = self.token_counter.count(content)
+                self.update_token_estimate()
 
                 self.display_file_attachment(file_name, preview)
             except Exception as e:
@@ -387,11 +3075,12 @@ class AIChatApp(QMainWindow):
     def display_file_attachment(self, file_name, preview):
         timestamp = QDateTime.currentDateTime().toString("yyyy-MM-dd hh:mm:ss")
         formatted_message = (
-            f"<div style='text-align: right; background-color: lightyellow; padding: 5px; border-radius: 10px;'>"
-            f"<small>[{timestamp}]</small> <b>You attached: {os.path.basename(file_name)}</b><br>"
-            f"<pre style='white-space: pre-wrap; font-family: monospace;'>{preview}</pre></div>"
+            f"<small>[{timestamp}]</small> <b>You attached: {html.escape(os.path.basename(file_name))}</b><br>"
+            f"<pre style='white-space: pre-wrap; font-family: monospace;'>{html.escape(preview)}</pre>"
         )
-        self.chat_browser.append(formatted_message)
+        row = self.transcript.append_row(ChatRow("attachment", "You", preview, f"[{timestamp}]", formatted_message))
+        self.chat_delegate.measure(row)
+        self.scroll_chat_to_bottom()
 
     # --- Sending and Displaying Messages ---
     def send_message(self):
@@ -404,191 +3093,417 @@ class AIChatApp(QMainWindow):
         if not user_input and not self.attached_file_content:
             return
 
-        timestamp = QDateTime.currentDateTime().toString("[yyyy-MM-dd hh:mm:ss]")
-        self.display_message("You", user_input, timestamp, is_user=True,
-                             file_attached=self.attached_file_name is not None)
-
-        self.chat_log.append(["You", full_message_content, timestamp])
+        # Catch prompts that cannot fit the model's context before anything is sent
+        prompt_tokens = self.pending_prompt_tokens()
+        limit = self.prompt_token_limit()
+        if limit is not None and prompt_tokens > limit:
+            QMessageBox.warning(self, "Prompt Too Large",
+                                f"This message is about {prompt_tokens:,} tokens, but only {limit:,} fit in the "
+                                f"context budget for '{self.config.get('Model')}'. Shorten it or attach a smaller file.")
+            return
 
-        # Log to session file
-        if self.session_log_file:
-            log_entry = ["You", full_message_content, timestamp]
-            self.write_to_session_log(log_entry)
+        timestamp = QDateTime.currentDateTime().toString("[yyyy-MM-dd hh:mm:ss]")
+        user_row = self.display_message("You", user_input, timestamp, is_user=True,
+                                        file_attached=self.attached_file_name is not None)
 
         self.input_box.clear()
         self.attached_file_content = None
         self.attached_file_name = None
+        self.attached_file_tokens = 0
+        self.update_token_estimate()
 
-        # Call API and handle response
-        self.call_api(full_message_content)
+        # Queue the request; the prompt joins chat_log together with its reply
+        self.enqueue_request(["You", full_message_content, timestamp], user_row,
+                             bypass_cache=self.bypass_cache_checkbox.isChecked())
+        self.bypass_cache_checkbox.setChecked(False)
 
     def display_message(self, sender, message, timestamp, is_user=False, file_attached=False, is_error=False):
-        formatted_message = self.format_whatsapp_text(message)
-        sender_display = "You" if is_user else "AI"
-        if is_user:
-            html_content = f"<div class='message user-message'><p>{html.escape(timestamp)} <b>{html.escape(sender_display)}:</b></p><p>{formatted_message}</p></div>"
-        elif is_error:
-            html_content = f"<div class='message error-message'><p>{html.escape(timestamp)} <b>{html.escape(sender_display)}:</b></p><p>{formatted_message}</p></div>"
-        else:
-            html_content = f"<div class='message ai-message'><p>{html.escape(timestamp)} <b>{html.escape(sender_display)}:</b></p><p>{formatted_message}</p></div>"
+        kind = "user" if is_user else "error" if is_error else "ai"
+        row = self.transcript.append_row(ChatRow(kind, "You" if is_user else "AI", message, timestamp))
+        self.chat_delegate.measure(row)  # It is about to be on screen, so skip the estimate
+        self.scroll_chat_to_bottom()  # Scroll to the end of chat
+        return row
+
+    def on_chat_scrolled(self):
+        scroll_bar = self.chat_view.verticalScrollBar()
+        self.follow_chat_bottom = scroll_bar.value() >= scroll_bar.maximum() - 4
+        if self.paged_session and scroll_bar.value() == scroll_bar.minimum():
+            self.load_older_page()
+
+    def scroll_chat_to_bottom(self):
+        # Deferred, so a burst of appended rows costs one layout pass instead of one per row
+        self.follow_chat_bottom = True
+        self.scroll_to_bottom_timer.start()
+
+    # --- Streaming AI bubble ---
+    def insert_reply_row(self, anchor_row, row):
+        # A reply goes directly under its own prompt, even if later prompts are already shown below it
+        position = self.transcript.row_of(anchor_row)
+        if position is None:  # The transcript was replaced while the request was running
+            position = self.transcript.rowCount() - 1
+        at_end = position == self.transcript.rowCount() - 1
+        self.transcript.insert_row(position + 1, row)
+        self.chat_delegate.measure(row)
+        if at_end:
+            self.scroll_chat_to_bottom()
+        return row
+
+    def begin_stream_bubble(self, request):
+        request.streaming = True
+        request.ai_row = None  # Created with the first delta so an instant failure leaves no empty bubble
+        request.stream_text = ""
+
+    def append_stream_delta(self, request, delta):
+        request.stream_text += delta
+        self.replace_stream_bubble(request, request.stream_text, streaming=True)
+
+    def replace_stream_bubble(self, request, message, streaming=False):
+        # Only the streaming row is re-rendered; the rest of the transcript is untouched
+        if request.ai_row is None:
+            timestamp = QDateTime.currentDateTime().toString("[yyyy-MM-dd hh:mm:ss]")
+            request.ai_row = self.insert_reply_row(request.user_row, ChatRow("ai", "AI", message, timestamp))
+        self.transcript.update_message(request.ai_row, message, streaming=streaming)
+        if self.follow_chat_bottom:
+            self.scroll_to_bottom_timer.start()
 
-        cursor = self.chat_browser.textCursor()
-        cursor.insertHtml(html_content)
-        cursor.insertBlock()
-        self.chat_browser.moveCursor(QTextCursor.MoveOperation.End)  # Scroll to the end of chat
+    def end_stream_bubble(self, request):
+        request.streaming = False
+        request.stream_text = ""
 
     def format_whatsapp_text(self, text):
-        # 1. Escape HTML entities (including quotes)
-        text = html.escape(text)
-
-        # 2. New conversion: Replace **text** with <b>&ast;text</b>&ast;
-        text = re.sub(r'\*\*\*\*(.*?)\*\*\*\*', r'<b>@#%@#%@#%\1@#%@#%@#%</b>', text)
-        text = re.sub(r'\*\*\*(.*?)\*\*\*', r'<b>@#%@#%\1@#%@#%</b>', text)
-        text = re.sub(r'\*\*(.*?)\*\*', r'<b>@#%\1@#%</b>', text)
-
-        # 3. Handle newlines *AFTER* escaping
-        text = text.replace("\n", "<br>")
-
-        # 4. Handle emojis (encode/decode for surrogate pairs)
-        text = text.encode('utf-16', 'surrogatepass').decode('utf-16')
-
-        # 5. Apply WhatsApp-style formatting tags
-        text = self.apply_whatsapp_tags(text)
-        text = re.sub(r'@#%', r'*', text)
-        return text
-
-    def apply_whatsapp_tags(self, text):
-        # Simplified placeholder method (robust and readable)
-        text = text.replace("*", "###BOLD###")
-        text = text.replace("###BOLD###", "<b>", 1)
-        text = text.replace("###BOLD###", "</b>", 1)
-        while "###BOLD###" in text:
-            text = text.replace("###BOLD###", "<b>", 1)
-            text = text.replace("###BOLD###", "</b>", 1)
-        text = text.replace("<b></b>", "")
-
-        text = text.replace("_", "###ITALIC###")
-        text = text.replace("###ITALIC###", "<i>", 1)
-        text = text.replace("###ITALIC###", "</i>", 1)
-        while "###ITALIC###" in text:
-            text = text.replace("###ITALIC###", "<i>", 1)
-            text = text.replace("###ITALIC###", "</i>", 1)
-        text = text.replace("<i></i>", "")
-
-        text = text.replace("~", "###STRIKE###")
-        text = text.replace("###STRIKE###", "<s>", 1)
-        text = text.replace("###STRIKE###", "</s>", 1)
-        while "###STRIKE###" in text:
-            text = text.replace("###STRIKE###", "<s>", 1)
-            text = text.replace("###STRIKE###", "</s>", 1)
-        text = text.replace("<s></s>", "")
-
-        return text
-
-    # --- API Call Function using OpenAI library ---
-    def call_api(self, prompt):
+        return self.render_cache.format(text)
+
+    # --- Request Queue ---
+    # Every prompt becomes a PendingRequest. Up to Max_Concurrent_Requests of them run at once; the
+    # rest wait in order. Finished requests are committed to chat_log and the session log strictly in
+    # the order the prompts were sent, so a fast reply never lands ahead of an earlier prompt.
+    def enqueue_request(self, user_entry, user_row, bypass_cache=False):
+        request = PendingRequest(user_entry, user_row, bypass_cache)
+        self.pending_requests.append(request)
         if not self.config:
             QMessageBox.warning(self, "API Error",
                                 "API configuration is missing. Please configure API settings.")
+            self.complete_request(request, None)
             return
         if not self.openai_client:
             QMessageBox.warning(self, "API Error", "OpenAI client not initialized. Check API configuration.")
+            self.complete_request(request, None)
+            return
+        self.waiting_requests.append(request)
+        self.dispatch_requests()
+
+    def max_concurrent_requests(self):
+        return max(1, int((self.config or {}).get('Max_Concurrent_Requests', 1)))
+
+    def dispatch_requests(self):
+        # Prompts go out in order while the rate limiter has budget for them. With more than one request
+        # allowed at a time, a smaller prompt that fits the remaining token budget may overtake a larger
+        # one that has to wait; replies are still committed in prompt order.
+        self.rate_limit_timer.stop()
+        model = (self.config or {}).get('Model')
+        reorder = self.max_concurrent_requests() > 1
+        soonest = None
+        for request in list(self.waiting_requests):
+            if len(self.running_requests) >= self.max_concurrent_requests():
+                break
+            messages = self.build_request_messages(request)
+            cached = None
+            if not request.cache_checked:
+                # A prompt held back by the rate limiter is re-examined on every pass; looking it up again
+                # would count a miss each time
+                request.cache_checked = True
+                cached = self.cached_response(request, messages)
+            if cached is not None:
+                # Answered locally: takes no request slot and no rate-limit budget
+                self.waiting_requests.remove(request)
+                self.handle_cached_response(request, *cached)
+                continue
+            tokens = sum(self.token_counter.count(message['content']) for message in messages)
+            endpoint, wait = self.router.reserve(model, tokens)
+            if wait <= 0:
+                self.waiting_requests.remove(request)
+                self.call_api(request, messages, tokens, endpoint)
+                continue
+            soonest = wait if soonest is None else min(soonest, wait)
+            if not reorder:
+                break
+        self.rate_limited = soonest is not None
+        if self.rate_limited:
+            self.rate_limit_timer.start(int(soonest * 1000) + 50)
+        self.update_queue_status()
+
+    def complete_request(self, request, reply_entry, reply_meta=None):
+        request.reply_entry = reply_entry
+        request.reply_meta = reply_meta
+        request.done = True
+        while self.pending_requests and self.pending_requests[0].done:
+            finished = self.pending_requests.pop(0)
+            for entry in (finished.user_entry, finished.reply_entry):
+                if entry is not None:
+                    self.chat_log.append(entry)
+                    self.write_to_session_log(entry)
+            if finished.reply_entry is not None and finished.reply_meta:
+                self.message_meta[len(self.chat_log) - 1] = finished.reply_meta
+                self.write_meta_to_session_log(finished.reply_meta)
+        self.update_queue_status()
+
+    def update_queue_status(self):
+        running, waiting = len(self.running_requests), len(self.waiting_requests)
+        self.stop_button.setVisible(bool(running or waiting))
+        limited = " (waiting for rate limit)" if waiting and self.rate_limited else ""
+        self.queue_label.setText(f"Requests: {running} running, {waiting} queued{limited}")
+        self.queue_label.setVisible(bool(running or waiting))
+
+    def update_rate_limit_status(self):
+        model = (self.config or {}).get('Model')
+        candidates = self.router.candidates(model) if self.openai_client else []
+        if not candidates:
+            self.rate_label.hide()
             return
+        endpoint, upstream_model = candidates[0]
+        budget = self.rate_limiter.describe(endpoint.api_key, upstream_model)
+        self.rate_label.setText(f"Rate budget: {budget} per minute")
+        self.rate_label.setVisible(bool(budget))
 
-        model = self.config.get('Model')
-        system_prompt = self.config.get('System_Prompt')
+    # --- API Call Function using OpenAI library ---
+    def build_request_messages(self, request):
+        # Prompts still waiting on earlier replies are not part of chat_log yet, so this one is passed
+        # separately as the latest user turn
+        return self.context_manager.build_messages(self.chat_log, self.config.get('System_Prompt'),
+                                                   self.config.get('Model'), pending=[request.user_entry],
+                                                   pinned_context=self.config.get('Pinned_Context'))
+
+    def is_cacheable(self, temperature):
+        # Only replies at or below Response_Cache_Max_Temperature are cached; sampled ones vary by design
+        return self.response_cache is not None and \
+            temperature <= float(self.config.get('Response_Cache_Max_Temperature', 0))
+
+    def cached_response(self, request, messages):
+        # (reply, bubble note) from the exact cache, else from the semantic cache, or None
         temperature = float(self.config.get('Temperature'))
+        if request.bypass_cache or not self.is_cacheable(temperature):
+            return None
+        model = self.config.get('Model')
+        content = self.response_cache.get([ResponseCache.key(endpoint.url, name, temperature, messages)
+                                           for endpoint, name in self.router.route_for(model)])
+        if content is not None:
+            return content, "cached reply"
+        if self.semantic_cache:
+            scope = SemanticCache.scope(model, temperature, messages)
+            match = self.semantic_cache.get(scope, messages[-1]['content'])
+            if match:
+                return match[0], f"cached reply to a similar prompt, {match[1]:.0%} match"
+        return None
+
+    def store_cached_response(self, request, content):
+        worker = request.worker
+        if worker.endpoint is None or not self.is_cacheable(worker.temperature):
+            return
+        key = ResponseCache.key(worker.endpoint.url, worker.upstream_model, worker.temperature, worker.messages)
+        self.response_cache.put(key, worker.upstream_model, content)
+        if self.semantic_cache:
+            scope = SemanticCache.scope(worker.model, worker.temperature, worker.messages)
+            self.semantic_cache.put(scope, worker.messages[-1]['content'], content)
 
-        try:
-            completion = self.openai_client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=temperature
-            )
-            ai_response_content = completion.choices[0].message.content
-            timestamp = QDateTime.currentDateTime().toString("[yyyy-MM-dd hh:mm:ss]")
-            self.display_message("AI", ai_response_content, timestamp)
-            self.chat_log.append(["AI", ai_response_content, timestamp])
-
-            # Log AI response to session file
-            if self.session_log_file:
-                log_entry = ["AI", ai_response_content, timestamp]
-                self.write_to_session_log(log_entry)
+    def handle_cached_response(self, request, content, note):
+        timestamp = QDateTime.currentDateTime().toString("[yyyy-MM-dd hh:mm:ss]")
+        row = ChatRow("ai", "AI", content, timestamp)
+        row.note = note
+        self.insert_reply_row(request.user_row, row)
+        self.statusBar().showMessage("Answered from the response cache.", 5000)
+        self.complete_request(request, ["AI", content, timestamp])
 
+    def call_api(self, request, messages, prompt_tokens, reserved_endpoint):
+        model = self.config.get('Model')
+        temperature = float(self.config.get('Temperature'))
 
-        except Exception as e:
-            error_message = f"API request failed: {e}"
-            self.display_message("AI", f"Error: {error_message}",
-                                 QDateTime.currentDateTime().toString("[yyyy-MM-dd hh:mm:ss]"),
-                                 is_error=True)
-            self.chat_log.append(
-                ["AI", f"Error: {error_message}", QDateTime.currentDateTime().toString("[yyyy-MM-dd hh:mm:ss]")])
+        stream = bool(self.config.get('Stream', True))
+        flush_interval_ms = int(self.config.get('Stream_Flush_Ms', 50))
+
+        # Run the completion in a worker thread so the event loop keeps running
+        worker = ApiRequestWorker(self.router, self.resilience, model, messages, temperature,
+                                  stream=stream, flush_interval_ms=flush_interval_ms,
+                                  prompt_tokens=prompt_tokens, reserved=reserved_endpoint,
+                                  stream_usage=bool(self.config.get('Stream_Include_Usage', True)), parent=self)
+        request.worker = worker
+        worker.retrying.connect(lambda message: self.statusBar().showMessage(message, 10000))
+        if stream:
+            self.begin_stream_bubble(request)
+            worker.delta_received.connect(lambda delta: self.append_stream_delta(request, delta))
+        worker.response_ready.connect(lambda content: self.handle_api_response(request, content))
+        worker.request_failed.connect(lambda error: self.handle_api_error(request, error))
+        worker.finished.connect(lambda: self.on_api_worker_finished(request))
+        self.running_requests.append(request)
+        worker.start()
+
+    def handle_api_response(self, request, ai_response_content):
+        self.store_cached_response(request, ai_response_content)
+        timestamp = QDateTime.currentDateTime().toString("[yyyy-MM-dd hh:mm:ss]")
+        # Kept out of the chat_log entry, which stays [sender, message, timestamp]
+        meta = {"timing": request.worker.timing}
+        usage = request.worker.usage
+        if usage:
+            meta["usage"] = usage
+            self.usage_totals["replies"] += 1
+            self.usage_totals["prompt_tokens"] += usage["prompt_tokens"]
+            self.usage_totals["cached_tokens"] += usage["cached_tokens"]
+        if request.streaming:
+            self.replace_stream_bubble(request, ai_response_content)
+            self.end_stream_bubble(request)
+            request.ai_row.details = format_reply_details(meta)
+        else:
+            row = ChatRow("ai", "AI", ai_response_content, timestamp)
+            row.details = format_reply_details(meta)
+            self.insert_reply_row(request.user_row, row)
+        self.complete_request(request, ["AI", ai_response_content, timestamp], meta)
+
+    def handle_api_error(self, request, error):
+        error_message = f"API request failed: {error}"
+        if request.streaming:
+            self.end_stream_bubble(request)  # Any partial text already streamed stays visible above the error
+        timestamp = QDateTime.currentDateTime().toString("[yyyy-MM-dd hh:mm:ss]")
+        # Below the partial reply if one was streamed, otherwise directly under the prompt
+        self.insert_reply_row(request.ai_row or request.user_row, ChatRow("error", "AI", f"Error: {error_message}", timestamp))
+        self.complete_request(request, ["AI", f"Error: {error_message}", timestamp])
+
+    def on_api_worker_finished(self, request):
+        request.worker.deleteLater()
+        request.worker = None
+        self.running_requests.remove(request)
+        self.dispatch_requests()
+        self.update_rate_limit_status()
+
+    def stop_request(self):
+        # Stops everything: running requests keep what they streamed, queued prompts are never sent
+        while self.waiting_requests:
+            self.complete_request(self.waiting_requests.popleft(), None)
+        for request in list(self.running_requests):
+            worker = request.worker
+            worker.cancel()
+            # Detach the worker so nothing it still emits reaches the chat; it is deleted once it exits
+            worker.response_ready.disconnect()
+            worker.request_failed.disconnect()
+            worker.retrying.disconnect()
+            if request.streaming:
+                worker.delta_received.disconnect()  # Only connected for streamed requests
+            worker.finished.disconnect()
+            self.stopped_workers.add(worker)
+            worker.finished.connect(lambda worker=worker: self.on_stopped_worker_finished(worker))
+            request.worker = None
+            self.running_requests.remove(request)
+            self.handle_api_cancelled(request)
+        self.update_queue_status()
+
+    def on_stopped_worker_finished(self, worker):
+        self.stopped_workers.discard(worker)
+        worker.deleteLater()
+
+    def handle_api_cancelled(self, request):
+        # Whatever was streamed before Stop is kept, both on screen and in the chat log
+        partial = request.stream_text if request.streaming else ""
+        if request.streaming:
+            if partial:
+                self.replace_stream_bubble(request, partial)
+            self.end_stream_bubble(request)
+        if not partial:
+            self.statusBar().showMessage("Request stopped.", 5000)
+            self.complete_request(request, None)
+            return
+        timestamp = QDateTime.currentDateTime().toString("[yyyy-MM-dd hh:mm:ss]")
+        self.statusBar().showMessage("Request stopped; the partial response was kept.", 5000)
+        self.complete_request(request, ["AI", partial, timestamp])
 
     def create_session_log(self):
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         timestamp_sn = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         log_dir = "chat_logs"
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir)  # Create the directory if it doesn't exist
-        log_file_path = os.path.join(log_dir, f"Chat_{timestamp}.json")
-
         try:
-            # Open in 'w' mode initially to create or overwrite
-            self.session_log_file = open(log_file_path, 'w')
-            log_data = {
-                "session_name": f"Chat {timestamp_sn}",
-                "chat_log": []
-            }
-            json.dump(log_data, self.session_log_file, indent=4)  # Write initial structure
-            self.session_log_file.flush()  # Ensure data is written to disk
-            self.session_log_file.close() # close to change to 'r+' mode
-            # Reopen in 'r+' mode for reading and writing
-            self.session_log_file = open(log_file_path, 'r+')
+            if not os.path.exists(log_dir):
+                os.makedirs(log_dir)  # Create the directory if it doesn't exist
         except Exception as e:
             QMessageBox.critical(self, "Logging Error", f"Could not create session log file: {e}")
-            self.session_log_file = None
+            return
+        self.session_log_path = os.path.join(log_dir, f"Chat_{timestamp}{SESSION_JOURNAL_EXT}")
+
+        config = self.config or {}
+        self.session_log_writer = SessionLogWriter(
+            self.session_log_path,
+            durability=config.get('Log_Durability', 'flush'),
+            fsync_every=int(config.get('Log_Fsync_Every', 10)),
+            queue_size=int(config.get('Log_Queue_Size', 1000)),
+            parent=self
+        )
+        self.session_log_writer.write_failed.connect(self.show_log_error)
+        self.session_log_writer.start()
+        self.session_log_writer.submit({"type": "session", "session_name": f"Chat {timestamp_sn}"})
+        self.session_log_messages = 0
 
     def write_to_session_log(self, log_entry):
-        if self.session_log_file:
-            try:
-                # Seek to the beginning *before* reading
-                self.session_log_file.seek(0)
-                data = json.load(self.session_log_file)
-                data['chat_log'].append(log_entry)
-
-                # Seek to the beginning again *before* writing (to overwrite)
-                self.session_log_file.seek(0)
-                self.session_log_file.truncate(0) # Clear the file
-                json.dump(data, self.session_log_file, indent=4)
-                self.session_log_file.flush()
-            except Exception as e:
-                QMessageBox.critical(self, "Logging Error", f"Could not write to session log file: {e}")
+        if self.session_log_writer:
+            self.session_log_writer.submit({"type": "message", "entry": log_entry})
+            self.session_log_messages += 1
+
+    def write_meta_to_session_log(self, meta):
+        # Belongs to the last message record; indexed by its position in the journal, not in chat_log
+        if self.session_log_writer and self.session_log_messages:
+            self.session_log_writer.submit({"type": "meta", "index": self.session_log_messages - 1, "meta": meta})
+
+    def show_log_error(self, error):
+        # Reported on the status bar rather than a modal box so logging never interrupts the chat
+        self.statusBar().showMessage(f"Logging Error: {error}", 10000)
 
     def close_session_log(self):
-        if self.session_log_file:
+        if self.session_log_writer:
+            self.session_log_writer.close()
+            self.session_log_writer = None
             try:
-                # Reload, add closing data, and write back
-                self.session_log_file.seek(0)
-                data = json.load(self.session_log_file)
-                data["attached_files"] = {}
-                data["created_at"] = datetime.datetime.now().timestamp()
-                self.session_log_file.seek(0)
-                self.session_log_file.truncate(0)
-                json.dump(data, self.session_log_file, indent=4)
-                self.session_log_file.close()
+                # Compact the journal into the Chat_*.json format used by earlier versions
+                if os.path.exists(self.session_log_path):
+                    json_path = compact_session_journal(self.session_log_path)
+                    if self.history_store:
+                        self.history_store.index_file(json_path)
             except Exception as e:
                 QMessageBox.critical(self, "Logging Error", f"Could not close session log file properly: {e}")
 
     def closeEvent(self, event):
         """Override closeEvent to ensure log file is closed."""
+        # Same as Stop: queued prompts are dropped and running requests are cancelled, keeping what they
+        # streamed. Cancelled workers exit within a poll interval, so only that short tail is waited on.
+        self.stop_request()
+        for worker in list(self.stopped_workers):
+            worker.wait()
+        if self.index_worker:
+            self.index_worker.wait()
+        if self.import_worker:
+            self.import_worker.wait()  # Parsing cannot be interrupted; its result is simply not shown
+        if self.export_worker:
+            self.export_worker.requestInterruption()  # Stops at the next message; the target is left untouched
+            self.export_worker.wait()
+        if self.warm_up_worker:
+            self.warm_up_worker.wait()
         self.close_session_log()
+        if self.history_store:
+            self.history_store.close()
+        if self.response_cache:
+            self.response_cache.close()
+        if self.http_pool:
+            self.http_pool.close()
         super().closeEvent(event)
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    if len(sys.argv) > 1 and sys.argv[1] == "--reindex":
+        # Headless bulk indexing: python ai_chat_app-v10.py --reindex [log_dir] [database]
+        log_dir = sys.argv[2] if len(sys.argv) > 2 else "chat_logs"
+        database_path = sys.argv[3] if len(sys.argv) > 3 else os.path.join(log_dir, "history.db")
+        store = ConversationStore(database_path)
+        try:
+            print(format_index_stats(reindex_chat_logs(store, log_dir)))
+        finally:
+            store.close()
+        sys.exit(0)
+
     app = QApplication(sys.argv)
     chat_app = AIChatApp()
     chat_app.show()
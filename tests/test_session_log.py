@@ -0,0 +1,61 @@
+# Session journal round trip: reply metadata must stay attached to its message in the compacted
+# Chat_*.json, also when chat_log already held imported entries that are not part of the journal.
+import importlib.util
+import json
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ai_chat_app-v10.py")
+spec = importlib.util.spec_from_file_location("ai_chat_app_v10", APP_PATH)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+META = {
+    "timing": {"connect_ms": 12, "tls_ms": None, "ttfb_ms": 150, "hedged": False, "endpoint": "api.example.com",
+               "model": "gpt-4o-mini", "stream": False, "attempts": 1, "ttft_ms": 210, "total_ms": 210,
+               "tokens_per_second": 20.0},
+    "usage": {"prompt_tokens": 10, "completion_tokens": 5, "cached_tokens": 8},
+}
+
+
+@pytest.fixture
+def window(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # Logs go to tmp_path/chat_logs
+    (tmp_path / "api_configuration.yaml").write_text("Model: gpt-4o-mini\n")  # No API key: nothing is sent
+    qt_app = app.QApplication.instance() or app.QApplication(sys.argv)
+    chat_window = app.AIChatApp()
+    yield chat_window
+    chat_window.close()
+    qt_app.processEvents()
+
+
+def test_reply_meta_survives_import_and_compaction(window, tmp_path):
+    imported = tmp_path / "Chat_imported.json"
+    imported.write_text(json.dumps({"session_name": "Imported", "chat_log": [
+        ["You", "first", "[2024-01-01 10:00:00]"],
+        ["AI", "first reply", "[2024-01-01 10:00:05]"],
+        ["You", "second", "[2024-01-01 10:01:00]"],
+        ["AI", "second reply", "[2024-01-01 10:01:05]"],
+    ]}), encoding="utf-8")
+    window.on_chat_history_loaded(app.load_session_file(str(imported)))
+
+    request = app.PendingRequest(["You", "third", "[2024-01-01 10:02:00]"], None)
+    window.pending_requests.append(request)
+    window.complete_request(request, ["AI", "third reply", "[2024-01-01 10:02:05]"], META)
+    assert window.message_meta == {5: META}
+
+    journal_path = window.session_log_path
+    window.close_session_log()
+    data = app.load_session_file(journal_path[:-len(app.SESSION_JOURNAL_EXT)] + ".json")
+
+    assert data["chat_log"] == [["You", "third", "[2024-01-01 10:02:00]"],
+                                ["AI", "third reply", "[2024-01-01 10:02:05]"]]
+    assert data["message_meta"] == {"1": META}
+    rows = [app.chat_row_for_entry(entry, data["message_meta"].get(str(index)))
+            for index, entry in enumerate(data["chat_log"])]
+    assert rows[0].details == ""
+    assert rows[1].details.startswith("gpt-4o-mini via api.example.com")
@@ -0,0 +1,80 @@
+# Golden outputs captured from the original sentinel-based format_whatsapp_text, which the linear
+# tokenizer replaced; the two must render every input identically.
+import importlib.util
+import os
+
+import pytest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ai_chat_app-v10.py")
+spec = importlib.util.spec_from_file_location("ai_chat_app_v10", APP_PATH)
+app = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(app)
+
+GOLDEN = [
+    ('plain text',
+     'plain text'),
+    ('',
+     ''),
+    ('*bold*',
+     '<b>bold</b>'),
+    ('_italic_',
+     '<i>italic</i>'),
+    ('~strike~',
+     '<s>strike</s>'),
+    ('*bold* and _italic_ and ~strike~',
+     '<b>bold</b> and <i>italic</i> and <s>strike</s>'),
+    ('**double**',
+     '<b>*double*</b>'),
+    ('***triple***',
+     '<b>**triple**</b>'),
+    ('****quad****',
+     '<b>***quad***</b>'),
+    ('**a** **b**',
+     '<b>*a*</b> <b>*b*</b>'),
+    ('*unbalanced',
+     '<b>unbalanced'),
+    ('_one _two _three',
+     '<i>one </i>two <i>three'),
+    ('~a~ ~b',
+     '<s>a</s> <s>b'),
+    ('line one\nline two',
+     'line one<br>line two'),
+    ('*bold\nacross*',
+     '<b>bold<br>across</b>'),
+    ('\n\n',
+     '<br><br>'),
+    ('emoji 😀 *star* 👍🏽',
+     'emoji 😀 <b>star</b> 👍🏽'),
+    ('𝒳 surrogate _pair_',
+     '𝒳 surrogate <i>pair</i>'),
+    ('<script>alert(\'x\')</script> & "quotes"',
+     '&lt;script&gt;alert(&#x27;x&#x27;)&lt;/script&gt; &amp; &quot;quotes&quot;'),
+    ('a*b*c*d',
+     'a<b>b</b>c<b>d'),
+    ('**',
+     ''),
+    ('***',
+     '<b>'),
+    ('****',
+     '<b>**</b>'),
+    ('*****',
+     '<b>**</b><b>'),
+    ('_*~nested~*_',
+     '<i><b><s>nested</s></b></i>'),
+    ('x_y_z snake_case_name',
+     'x<i>y</i>z snake<i>case</i>name'),
+    ('2 * 3 * 4 = 24',
+     '2 <b> 3 </b> 4 = 24'),
+    ('**bold _inner_ text**',
+     '<b>*bold <i>inner</i> text*</b>'),
+    ('~~double tilde~~',
+     'double tilde'),
+    ('mixed **a*b** end',
+     'mixed <b>*a<b>b*</b> end'),
+]
+
+
+@pytest.mark.parametrize("text, expected", GOLDEN)
+def test_matches_original_formatter(text, expected):
+    assert app.format_whatsapp_text(text) == expected
+